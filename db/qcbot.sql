@@ -9,7 +9,8 @@ CREATE TABLE IF NOT EXISTS players (
     handle  TEXT    DEFAULT "UNK"	NOT NULL,
     matches INTEGER DEFAULT 0       NOT NULL CHECK(matches >= 0),
     wins    INTEGER DEFAULT 0       NOT NULL CHECK(matches >= wins AND wins >= 0),
-    ruins   INTEGER DEFAULT 0       NOT NULL CHECK(matches >= ruins AND ruins >= 0)
+    ruins   INTEGER DEFAULT 0       NOT NULL CHECK(matches >= ruins AND ruins >= 0),
+    rating  INTEGER DEFAULT 0       NOT NULL
 
 ) WITHOUT ROWID;
 
@@ -19,6 +20,7 @@ CREATE TABLE IF NOT EXISTS matches (
 	hostid	TEXT					NOT NULL,
 	mode	TEXT	DEFAULT "UNK"	NOT NULL,
 	winner	INTEGER DEFAULT 0		NOT NULL CHECK(winner >= -1 AND winner <= 2),
+	msgid	TEXT,
 
 	FOREIGN KEY (hostid) REFERENCES players(id) ON DELETE SET NULL
 );
@@ -26,24 +28,26 @@ CREATE TABLE IF NOT EXISTS matches (
 CREATE VIEW IF NOT EXISTS matches_active AS 
 	SELECT id, hostid, mode, winner FROM matches WHERE winner < 1;
 
-CREATE TABLE IF NOT EXISTS team1 (
+CREATE TABLE IF NOT EXISTS match_players (
 
-	id 		INTEGER					PRIMARY KEY,
-	slot0 	TEXT					CHECK(slot0 != slot1 AND slot0 != slot2 AND slot0 != slot3),
-	slot1 	TEXT					CHECK(slot1 != slot0 AND slot1 != slot2 AND slot1 != slot3),
-	slot2 	TEXT					CHECK(slot2 != slot0 AND slot2 != slot1 AND slot2 != slot3),
-	slot3 	TEXT					CHECK(slot3 != slot0 AND slot3 != slot1 AND slot3 != slot2),
+	match_id	INTEGER		NOT NULL,
+	player_id	TEXT		NOT NULL,
+	team		INTEGER		NOT NULL CHECK(team == 1 OR team == 2),
+	slot		INTEGER		NOT NULL CHECK(slot >= 0),
 
-	FOREIGN KEY (id) REFERENCES matches(id) ON DELETE CASCADE
+	PRIMARY KEY (match_id, team, slot),
+	UNIQUE (match_id, player_id),
+	FOREIGN KEY (match_id) REFERENCES matches(id) ON DELETE CASCADE
 ) WITHOUT ROWID;
 
-CREATE TABLE IF NOT EXISTS team2 (
+-- lookups by match_id use the primary key
+CREATE INDEX IF NOT EXISTS match_players_player ON match_players(player_id);
 
-	id 		INTEGER 				PRIMARY KEY,
-	slot0 	TEXT					CHECK(slot0 != slot1 AND slot0 != slot2 AND slot0 != slot3),
-	slot1 	TEXT					CHECK(slot1 != slot0 AND slot1 != slot2 AND slot1 != slot3),
-	slot2 	TEXT					CHECK(slot2 != slot0 AND slot2 != slot1 AND slot2 != slot3),
-	slot3 	TEXT					CHECK(slot3 != slot0 AND slot3 != slot1 AND slot3 != slot2),
+CREATE TABLE IF NOT EXISTS bans (
 
-	FOREIGN KEY (id) REFERENCES matches(id) ON DELETE CASCADE
-) WITHOUT ROWID;
\ No newline at end of file
+	player_id	TEXT		PRIMARY KEY,
+	expires		INTEGER		NOT NULL,
+	minutes		INTEGER		NOT NULL,
+	reason		TEXT	DEFAULT ""	NOT NULL
+
+) WITHOUT ROWID;
@@ -4,10 +4,12 @@ import json
 
 import discord
 
-from .database import QCDB
+from .database import QCDB, AsyncQCDB
 from .match import Match
 from .pug import Pug
 from .conf import Config
+from .dispatch import Dispatcher
+from .scheduler import ReactionScheduler, EditCoalescer, BroadcastQueue
 from .exceptions import MatchError
 
 class QuakeBot:
@@ -23,9 +25,29 @@ class QuakeBot:
         database interactions (e.g. players joining/leaving
         lobbies, reporting match wins, etc.)
 
-    self.db (qcbot.database.QCDB)
+    self.db (qcbot.database.AsyncQCDB)
         has API functions to interact with the sqlite3
         database that holds PUG tables like players, matches, etc.
+        every call is a coroutine that runs off the event loop
+
+    self.reactions (qcbot.scheduler.ReactionScheduler)
+        adds the shortcut reactions to lobby messages in the background
+        so commands don't wait on discord's reaction rate limit
+
+    self.edits (qcbot.scheduler.EditCoalescer)
+        batches lobby message edits so a burst of roster changes
+        turns into a single edit
+
+    self.broadcasts (qcbot.scheduler.BroadcastQueue)
+        collects low priority broadcasts into digest messages
+
+    self.dispatch (qcbot.dispatch.Dispatcher)
+        the command table for this bot's prefix. call build_dispatcher()
+        after the commands are reloaded or the prefix changes
+
+    self.member_roles (dict, key: str, val: frozenset [str])
+        member id -> ids of the member's roles, so permission checks
+        don't scan the member list. kept current by the member events
 
     self.shortcuts (dict, key: str, val: discord.Emoji or str)
         holds reactions that serve as shortcuts for typed commands.
@@ -39,6 +61,17 @@ class QuakeBot:
         and shut down
     """
 
+    #events the bot actually does something with. the client doesn't
+    #pass the rest down, add the event here when a handler gets a body
+    SUBSCRIBED = frozenset((
+        'on_message',
+        'on_message_delete',
+        'on_reaction_add',
+        'on_member_join',
+        'on_member_remove',
+        'on_member_update',
+    ))
+
     def __init__(self, client, server, path):
         self.client = client
         self.server = server
@@ -51,8 +84,9 @@ class QuakeBot:
             if not os.path.exists(self.server_directory):
                 os.makedirs(self.server_directory)
 
+            #settings missing from older files keep their default
             with open(settings_path, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
+                settings.update(json.load(f))
         except IOError:
             with open(settings_path, 'w', encoding='utf-8') as f:
                 json.dump(settings, f)
@@ -61,14 +95,28 @@ class QuakeBot:
             raise
 
         self.conf = Config(settings)
+        if self.conf.migrate_whitelist(server):
+            self.dump_config()
         self.add_cmds_to_config()
+        self.dispatch = Dispatcher(self.conf.prefix, self.client.cmds)
 
-        # load the player/match database
-        self.db = QCDB(self.server_directory + '/{}.db'.format(server.id))
-        self.db.setup(path + '/db/qcbot.sql')
+        # open the player/match database, setup() creates/upgrades it
+        self.schema = path + '/db/qcbot.sql'
+        qcdb = QCDB(self.server_directory + '/{}.db'.format(server.id))
+        self.db = AsyncQCDB(qcdb, loop=client.loop)
 
         # create pug functionality
         self.pug = Pug(self.conf.generate_maplist())
+        self.reactions = ReactionScheduler(client, self.conf.reaction_rate)
+        self.edits = EditCoalescer(client, self.conf.edit_delay)
+        self.broadcasts = BroadcastQueue(client, self.conf.broadcast_delay)
+        self._away = {}
+        self._away_tasks = set()
+
+        # index member roles
+        self.member_roles = {}
+        for member in server.members:
+            self.index_member(member)
 
         # load the shortcuts
         self.shortcuts = {}
@@ -88,37 +136,78 @@ class QuakeBot:
 
         for cmd in self.client.cmds:
             if not cmd in self.conf.whitelist:
-                self.conf.whitelist[cmd] = []
+                self.conf.set_whitelist(cmd, [])
         else:
             self.dump_config()        
 
+    def index_member(self, member):
+        self.member_roles[member.id] = frozenset(role.id for role in member.roles)
+
+    def has_role(self, member_id, role_id):
+        """returns: bool (True if the member has the role)"""
+
+        roles = self.member_roles.get(member_id)
+        if roles is None:
+            #not indexed yet, like a member discord hadn't sent us
+            member = self.server.get_member(member_id)
+            if member is None:
+                return False
+            self.index_member(member)
+            roles = self.member_roles[member_id]
+        return role_id in roles
+
+    def build_dispatcher(self):
+        self.dispatch.rebuild(self.conf.prefix, self.client.cmds)
+
     def dump_config(self):
         conf_dir = self.server_directory + '/settings.json'
         with open(conf_dir, 'w', encoding='utf-8') as f:
             json.dump(self.conf.serial(), f)
 
-    async def broadcast(self, priority, content):
+    async def broadcast(self, priority, content, urgent=False):
+        """Priority 1 broadcasts and urgent ones are sent right away,
+        the rest are batched into a digest."""
+
         if priority <= self.conf.verbosity:
             if self.conf.brd_chan:
-                await self.client.send_message(self.conf.brd_chan, content)
+                if priority <= 1 or urgent:
+                    await self.broadcasts.send(self.conf.brd_chan, content)
+                else:
+                    self.broadcasts.queue(self.conf.brd_chan, content)
 
 
     #---------------------------------------
     # discord events passed from the client
     #---------------------------------------
 
+    async def setup(self):
+        """Creates or upgrades the database. Runs on the database's
+        writer thread so migrating a big database doesn't block the
+        event loop (and every other server's bot) while it runs."""
+
+        await self.db.setup(self.schema)
+
     async def logout(self):
+        #stop everything that could still touch the database
+        for task in self._away_tasks:
+            task.cancel()
+        self._away.clear()
+        self.pug.close()
+
         self.dump_config()
+        self.reactions.close()
+        self.edits.close()
+        await self.broadcasts.flush_all()
+        self.broadcasts.close()
+        await self.db.close()
 
     async def on_ready(self):
-        await self.client.purge_from(self.conf.pug_chan)
         await self.pug.on_ready(self)
 
     async def on_message(self, message):
-        if message.content.startswith(self.conf.prefix):
-            content = message.content.split(' ')
-            if content[0][1:] in self.client.cmds:
-                await self.client.cmds[content[0][1:]](self, message, split_text=content)
+        cmd, split_text = self.dispatch.match(message.content)
+        if cmd:
+            await cmd(self, message, split_text=split_text)
 
         #automatically delete any message sent in the pug channel
         #that isn't from the bot or doesn't start with #
@@ -133,20 +222,19 @@ class QuakeBot:
         pass
 
     async def on_message_delete(self, message):
-        pass
+        self.reactions.cancel(message)
+        self.edits.forget(message)
 
     async def on_reaction_add(self, reaction, user):
         chk1 = reaction.message.channel.id == self.conf.pug_chan.id
         chk2 = user is not reaction.message.server.me
         if chk1 and chk2:
-            for m_id, match in self.pug.m_cache.items():
-                if match['message'].id == reaction.message.id:
-                    try:
-                        await self._handle_reaction(reaction, user, m_id, match)
-                    except MatchError:
-                        pass
-                    finally:
-                        break
+            m_id, match = self.pug.match_by_message(reaction.message.id)
+            if match:
+                try:
+                    await self._handle_reaction(reaction, user, m_id, match)
+                except MatchError:
+                    pass
             try:
                 await self.client.remove_reaction(reaction.message, reaction.emoji, user)
             except discord.errors.NotFound:
@@ -159,27 +247,63 @@ class QuakeBot:
         pass
 
     async def on_member_join(self, member):
-        pass
+        self.index_member(member)
 
     async def on_member_remove(self, member):
-        pass
+        self.member_roles.pop(member.id, None)
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.index_member(after)
+
+        #almost every presence change is from someone who isn't in a lobby
+        m_id = self.pug.p_index.get(after.id)
+        if m_id is None:
+            return
 
-    async def on_member_update(self, after):
         if after.status.value in ('idle', 'offline'):
-            for m_id, match in self.pug.m_cache.items():
-                if after.id in match['players']:
-                    if self.conf.auto_kick and match['status'] == Match.LOBBY:
-                        reason = 'Went offline.' if after.status.value == 'offline' else 'Went AFK.'
-                        try:
-                            await self.pug._kick_player(self, self.server.me.id,
-                                                        m_id, match,
-                                                        match['players'].index(after.id),
-                                                        reason=reason)
-                        except MatchError:
-                            pass
-                    else:
-                        await self.pug.unready(self, after.id, after.display_name, m_id, match)
+            #collect everyone in the lobby who drops around the same time
+            #and deal with them together
+            batch = self._away.get(m_id)
+            if batch is None:
+                batch = self._away[m_id] = {}
+                task = self.client.loop.create_task(self._handle_away(m_id))
+                self._away_tasks.add(task)
+                task.add_done_callback(self._away_tasks.discard)
+            batch[after.id] = after
+        elif m_id in self._away:
+            #came back before the batch was handled
+            self._away[m_id].pop(after.id, None)
+
+    async def _handle_away(self, match_id):
+        """Kicks (or unreadies) every player in the lobby that went
+        offline/AFK within presence_delay of the first one, under a single
+        hold of the match lock, so a wave of disconnects is one pass
+        over the lobby and one lobby edit."""
+
+        await asyncio.sleep(self.conf.presence_delay)
+        batch = self._away.pop(match_id, {})
+
+        async with self.pug.lock(match_id):
+            for member in batch.values():
+                #the lobby might have changed (or be gone) by now
+                match = self.pug.m_cache.get(match_id)
+                if match is None:
                     break
+                if member.id not in match['players']:
+                    continue
+
+                if self.conf.auto_kick and match['status'] == Match.LOBBY:
+                    reason = 'Went offline.' if member.status.value == 'offline' else 'Went AFK.'
+                    try:
+                        await self.pug._kick_player(self, self.server.me.id,
+                                                    match_id, match,
+                                                    match['players'].index(member.id),
+                                                    reason=reason)
+                    except MatchError:
+                        pass
+                elif member.id in match['ready']:
+                    await self.pug.unready(self, member.id, member.display_name, match_id, match)
 
     #---------------------------------------
     #---------------------------------------
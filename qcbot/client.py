@@ -14,10 +14,10 @@ class QuakeClient(discord.Client):
     passes async events (messages, reactions, etc.) from discord API
     down to the bots that do the actual work.
 
-    self.bots (list)
-        QuakeBot objects for each server the client is connected
-        to. Each bot handles events that come from its own
-        respective server.
+    self.bots (dict, key: str, val: qcbot.bot.QuakeBot)
+        server id -> the bot for that server. Each bot handles
+        events that come from its own respective server, events
+        are looked up here by _route.
 
     self.cmds (dict)
         commands from commands module that can be triggered
@@ -49,7 +49,7 @@ class QuakeClient(discord.Client):
         self.meta_reload = 'reload'
         self.meta_print = 'print'
         
-        self.bots = []
+        self.bots = {}
         self.cmds = self._load_cmds()
 
     def _load_cmds(self):
@@ -70,18 +70,48 @@ class QuakeClient(discord.Client):
 
         return cmds
 
-    def _spawn(self, server):
+    async def _spawn(self, server):
         """Spawn a bot for a server. Each bot has their
         own configuration file, database, & directory
-        in the cwd.
+        in the cwd. A bot already running for the server
+        (like after a reconnect) is logged out first so its
+        database threads and timers don't leak.
 
         args: discord.Server
         returns: QuakeBot
         """
-        
+
+        await self._despawn(server)
+
         bot = QuakeBot(self, server, os.getcwd())
-        self.bots.append(bot)
+        try:
+            await bot.setup()
+        except Exception:
+            #don't leave its database threads behind
+            await bot.db.close()
+            raise
+        self.bots[server.id] = bot
+
+        return bot
+
+    async def _despawn(self, server):
+        bot = self.bots.pop(server.id, None)
+        if bot is not None:
+            await bot.logout()
+
+    def _route(self, server, event):
+        """Finds the bot that should handle an event from a server.
+
+        returns: QuakeBot or None if there's no bot for the server (or the
+        event came from a private channel) or the bot ignores the event
+        """
+
+        if server is None:
+            return None
 
+        bot = self.bots.get(server.id)
+        if bot is None or event not in bot.SUBSCRIBED:
+            return None
         return bot
 
 
@@ -93,7 +123,7 @@ class QuakeClient(discord.Client):
         super().run(self.token)
 
     async def logout(self):
-        for bot in self.bots:
+        for bot in self.bots.values():
             await bot.logout()
 
         super().logout()
@@ -105,26 +135,20 @@ class QuakeClient(discord.Client):
         print(self.user.id)
 
         for server in self.servers:
-            bot = self._spawn(server)
+            bot = await self._spawn(server)
             await bot.on_ready()
 
         await self.change_presence(game=discord.Game(name='Quake Champions'))
             
     async def on_server_join(self, server):
-        self._spawn(server)
+        await self._spawn(server)
 
     async def on_server_remove(self, server):
-        for bot in self.bots:
-            if bot.server is server:
-                killed = bot
-                break
-
-        self.bots.remove(killed)
+        await self._despawn(server)
 
     async def on_message(self, message):
-        chk_meta_prefix = message.content[0] == self.meta_command_prefix
         chk_for_bot_creator = message.author.id == self.creator_id
-        if chk_meta_prefix and chk_for_bot_creator:
+        if chk_for_bot_creator and message.content.startswith(self.meta_command_prefix):
             if message.content[1:].startswith(self.meta_kill):
                 cur_time = datetime.datetime.now().strftime("%H:%M %m-%d-%Y")
                 print('Logging out and closing...' + cur_time)
@@ -133,33 +157,30 @@ class QuakeClient(discord.Client):
             elif message.content[1:].startswith(self.meta_reload):
                 QuakeClient.ImportCmds()
                 self.cmds = self._load_cmds()
-                for bot in self.bots:
+                for bot in self.bots.values():
                     bot.add_cmds_to_config()
+                    bot.build_dispatcher()
             elif message.content[1:].startswith(self.meta_print):
                 print(message.content)
         else:
-            for bot in self.bots:
-                if message.server.id == bot.server.id:
-                    await bot.on_message(message)
-                    break
+            bot = self._route(message.server, 'on_message')
+            if bot:
+                await bot.on_message(message)
 
     async def on_message_edit(self, before, after):
-        for bot in self.bots:
-            if before.server.id == bot.server.id:
-                await bot.on_message_edit(before, after)
-                break
+        bot = self._route(before.server, 'on_message_edit')
+        if bot:
+            await bot.on_message_edit(before, after)
 
     async def on_message_delete(self, message):
-        for bot in self.bots:
-            if message.server.id == bot.server.id:
-                await bot.on_message_delete(message)
-                break
+        bot = self._route(message.server, 'on_message_delete')
+        if bot:
+            await bot.on_message_delete(message)
 
     async def on_reaction_add(self, reaction, user):
-        for bot in self.bots:
-            if reaction.message.server.id == bot.server.id:
-                await bot.on_reaction_add(reaction, user)
-                break
+        bot = self._route(reaction.message.server, 'on_reaction_add')
+        if bot:
+            await bot.on_reaction_add(reaction, user)
 
     async def on_reaction_remove(self, reaction, user):
         pass
@@ -168,19 +189,16 @@ class QuakeClient(discord.Client):
         pass
     
     async def on_member_join(self, member):
-        for bot in self.bots:
-            if member.server.id == bot.server.id:
-                await bot.on_member_join(member)
-                break
+        bot = self._route(member.server, 'on_member_join')
+        if bot:
+            await bot.on_member_join(member)
     
     async def on_member_remove(self, member):
-        for bot in self.bots:
-            if member.server.id == bot.server.id:
-                await bot.on_member_remove(member)
-                break
+        bot = self._route(member.server, 'on_member_remove')
+        if bot:
+            await bot.on_member_remove(member)
 
     async def on_member_update(self, before, after):
-        for bot in self.bots:
-            if after.server.id == bot.server.id:
-                await bot.on_member_update(after)
-                break
\ No newline at end of file
+        bot = self._route(after.server, 'on_member_update')
+        if bot:
+            await bot.on_member_update(before, after)
\ No newline at end of file
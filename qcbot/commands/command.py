@@ -1,27 +1,46 @@
 from ..exceptions import CommandError
 
+#permission checks a command can require, each takes (bot, message, name)
+#and returns True if the message is allowed through
+
+def _is_admin(bot, message, name):
+    return message.author.server_permissions.administrator
+
+def _is_mod(bot, message, name):
+    return (message.author.server_permissions.administrator
+            or bot.has_role(message.author.id, bot.conf.mod_role.id))
+
+def _not_private(bot, message, name):
+    return not message.channel.is_private
+
+def _whitelisted(bot, message, name):
+    chans = bot.conf.whitelist_sets[name]
+    return not chans or message.channel.id in chans
+
 def command(name,
             help_str='',
             admin_only=False,
             mod_only=False,
             disallow_private=True,
-            whitelist=False):
+            whitelist=False,
+            aliases=()):
+
+    #work out once which checks this command needs
+    checks = []
+    if admin_only:
+        checks.append(_is_admin)
+    if mod_only:
+        checks.append(_is_mod)
+    if disallow_private:
+        checks.append(_not_private)
+    if whitelist:
+        checks.append(_whitelisted)
+    checks = tuple(checks)
 
     def wrap(func):
         async def deco(bot, message, *args, **kwargs):
-            if admin_only and not message.author.server_permissions.administrator:
-                return
-            if mod_only and not message.author.server_permissions.administrator:
-                for role in message.author.roles:
-                    if role.id == bot.conf.mod_role.id:
-                        break
-                else:
-                    return
-            if disallow_private and message.channel.is_private:
-                return
-            if whitelist:
-                if (bot.conf.whitelist[name]
-                    and not message.channel.name in bot.conf.whitelist[name]):
+            for check in checks:
+                if not check(bot, message, name):
                     return
 
             try:
@@ -38,6 +57,8 @@ def command(name,
         setattr(deco, 'admin_only', admin_only)
         setattr(deco, 'mod_only', mod_only)
         setattr(deco, 'help_str', help_str)
+        setattr(deco, 'aliases', tuple(aliases))
+        setattr(deco, 'checks', checks)
 
         return deco
     return wrap
\ No newline at end of file
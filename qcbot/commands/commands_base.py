@@ -2,6 +2,16 @@ from .command import command
 
 import random
 
+def _channel_names(bot, channel_ids):
+    """Whitelists hold channel ids, help shows names since it's
+    in a code block where mentions don't render."""
+
+    names = []
+    for chan_id in channel_ids:
+        chan = bot.server.get_channel(chan_id)
+        names.append(chan.name if chan else chan_id)
+    return names
+
 @command('help', whitelist=True)
 async def help(bot, message, **kwargs):
     cmds = 'USER COMMANDS:\n'
@@ -12,7 +22,7 @@ async def help(bot, message, **kwargs):
         except:
             help_str = ''
         if bot.client.cmds[cmd].whitelist and bot.conf.whitelist[cmd]:
-            allowed_chans = ' ' + str(bot.conf.whitelist[cmd])
+            allowed_chans = ' ' + str(_channel_names(bot, bot.conf.whitelist[cmd]))
         if not bot.client.cmds[cmd].admin_only:
             cmds += (bot.conf.prefix + cmd + ' ' + help_str + allowed_chans + '\n')
 
@@ -28,7 +38,7 @@ async def help_admin(bot, message, **kwargs):
         except:
             help_str = ''
         if bot.client.cmds[cmd].whitelist and bot.conf.whitelist[cmd]:
-            allowed_chans = ' ' + str(bot.conf.whitelist[cmd])
+            allowed_chans = ' ' + str(_channel_names(bot, bot.conf.whitelist[cmd]))
         if bot.client.cmds[cmd].admin_only:
             cmds_admin += (bot.conf.prefix + cmd + ' ' + help_str + allowed_chans + '\n')
 
@@ -119,6 +119,11 @@ async def cfgdump(bot, message, **kwargs):
             m_id, match['mode'], match['status'], match['host']
             )
 
+    cache = bot.db.player_cache
+    s += '\nplayer cache: {}/{} records, {} hits, {} misses'.format(
+        len(cache), cache.maxsize, cache.hits, cache.misses
+        )
+
     s += '```'
 
     await bot.client.send_message(message.channel, s)
@@ -178,6 +183,7 @@ async def prefix(bot, message, split_text=[], **kwargs):
         raise CommandError('That character is reserved.')
 
     bot.conf.prefix = split_text[1]
+    bot.build_dispatcher()
     await bot.client.send_message(message.channel, 'Bot command prefix changed to {}'.format(bot.conf.prefix))
 
 @command('cfg_whitelist', help_str='<command> <channel_1_name> <channel_2_name> <...>', admin_only=True)
@@ -192,7 +198,7 @@ async def whitelist(bot, message, split_text=[], **kwargs):
         for arg in split_text[2:]:
             chan = discord.utils.find(lambda x: x.name == arg and x.type == discord.ChannelType.text, message.server.channels)
             if chan is not None:
-                whitelist_channels.append(chan.name)
+                whitelist_channels.append(chan.id)
             else:
                 raise CommandError('Channel not found.')
 
@@ -201,10 +207,11 @@ async def whitelist(bot, message, split_text=[], **kwargs):
     except CommandError:
         raise
     else:
-        bot.conf.whitelist[split_text[1]] = whitelist_channels
+        bot.conf.set_whitelist(split_text[1], whitelist_channels)
         bot.dump_config()
         if whitelist_channels:
-            await bot.client.send_message(message.channel, '{} reserved to: {}'.format(split_text[1], whitelist_channels))
+            chans = ' '.join('<#{}>'.format(chan) for chan in whitelist_channels)
+            await bot.client.send_message(message.channel, '{} reserved to: {}'.format(split_text[1], chans))
         else:
             await bot.client.send_message(message.channel, '{} is now allowed on all channels.'.format(split_text[1]))
 
@@ -319,12 +326,12 @@ async def ban(bot, message, split_text=[], **kwargs):
         raise CommandError('You cannot ban yourself.')
     if check.server_permissions.administrator:
         raise CommandError('You cannot ban admins.')
-    if bot.conf.mod_role.id in [role.id for role in check.roles]:
+    if bot.has_role(check.id, bot.conf.mod_role.id):
         raise CommandError('You cannot ban moderators.')
 
     mins = int(split_text[2])
     if mins > 0:
-        bot.pug.ban(bot.client.loop, check.id, mins, reason)
+        await bot.pug.ban(bot, check.id, mins, reason)
 
         await bot.client.send_message(message.channel, '{} has been banned for {} minutes. Reason: {}'.format(check.display_name, mins, reason))
     
@@ -339,8 +346,7 @@ async def forgive(bot, message, split_text=[], **kwargs):
     if not check:
         raise CommandError('That person doesn\'t exist. Make sure to use \'@\'.')
 
-    if check.id in bot.pug.banned:
-        del bot.pug.banned[check.id]
+    if await bot.pug.unban(bot, check.id):
         await bot.client.send_message(message.channel, '{} has been unbanned.'.format(check.display_name))
 
 @command('force_cancel', help_str='<lobby #>', mod_only=True)
@@ -351,9 +357,10 @@ async def force_cancel(bot, message, split_text=[], **kwargs):
         raise CommandError('Invalid lobby number.')
 
     lobby_num = int(split_text[1])
-    if lobby_num in bot.pug.m_cache:
-        try: await bot.pug._cancel_match(bot, lobby_num)
-        except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
+    async with bot.pug.lock(lobby_num):
+        if lobby_num in bot.pug.m_cache:
+            try: await bot.pug._cancel_match(bot, lobby_num)
+            except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
 
 @command('force_start', help_str='<lobby #>', mod_only=True)
 async def force_start(bot, message, split_text=[], **kwargs):
@@ -363,9 +370,10 @@ async def force_start(bot, message, split_text=[], **kwargs):
         raise CommandError('Invalid lobby number.')
 
     lobby_num = int(split_text[1])
-    if lobby_num in bot.pug.m_cache:
-        try: await bot.pug._start_match(bot, lobby_num, bot.pug.m_cache[lobby_num])
-        except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
+    async with bot.pug.lock(lobby_num):
+        if lobby_num in bot.pug.m_cache:
+            try: await bot.pug._start_match(bot, lobby_num, bot.pug.m_cache[lobby_num])
+            except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
 
 @command('force_end', help_str='<lobby #> <winning team>', mod_only=True)
 async def force_end(bot, message, split_text=[], **kwargs):
@@ -382,9 +390,10 @@ async def force_end(bot, message, split_text=[], **kwargs):
         raise CommandError('Invalid team.')    
    
     lobby_num = int(split_text[1])
-    if lobby_num in bot.pug.m_cache:
-        try: await bot.pug._end_match(bot, lobby_num, bot.pug.m_cache[lobby_num], team)
-        except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
+    async with bot.pug.lock(lobby_num):
+        if lobby_num in bot.pug.m_cache:
+            try: await bot.pug._end_match(bot, lobby_num, bot.pug.m_cache[lobby_num], team)
+            except MatchError as e: await bot.client.send_message(message.channel, e.args[0])
 
 @command('force_kick', help_str='<lobby #> <slot #>', mod_only=True)
 async def force_kick(bot, message, split_text=[], **kwargs):
@@ -552,12 +561,12 @@ async def handle(bot, message, split_text=[], **kwargs):
         else:
             raise CommandError('Name contains invalid characters.')
     else:
-        bot.db.change_player_name(message.author.id, new_name)
+        await bot.db.change_player_name(message.author.id, new_name)
         await bot.client.send_message(message.channel, 'Your in-game handle has been changed to ' + new_name)
 
 @command('pugstats', whitelist=True)
 async def stats(bot, message, **kwargs):
-    stats = bot.db.get_player_record(message.author.id)
+    stats = await bot.db.get_player_record(message.author.id)
 
     if stats:
         num_matches = stats[1]
@@ -583,7 +592,7 @@ async def top(bot, message, split_text=[], **kwargs):
     else:
         raise CommandError('Invalid arguments.')
 
-    top_stats = bot.db.get_top_players(limit)
+    top_stats = await bot.db.get_top_players(limit)
 
     s = 'TOP LADS:\n```'
     for i, player in enumerate(top_stats):
@@ -610,24 +619,29 @@ async def recent(bot, message, split_text=[], **kwargs):
     else:
         raise CommandError('Invalid arguments.')
 
-    recent_matches = bot.db.get_past_matches(limit)
+    recent_matches = await bot.db.get_recent_matches(limit)
+    await bot.client.send_message(message.channel, _format_recent(message.server, recent_matches))
+
+def _format_recent(server, recent_matches):
+    """Formats the output of QCDB.get_recent_matches for !recent. Winners
+    that are still in the server are shown with their display name,
+    otherwise with their in-game handle.
+    """
 
     s = 'Most recent games:\n```'
 
-    for match in recent_matches:
-        s += '#{} {} | '.format(match[0], match[2])
+    for match_id, mode, winner, players in recent_matches:
+        s += '#{} {} | '.format(match_id, mode)
 
-        winning_team = 'team' + str(match[3])
         s += 'winner(s): '
-        for player in bot.db.get_players_on_team(match[0], winning_team):
-            if player:
-                member = discord.utils.get(message.server.members, id=player)
-                if member:
-                    s += member.display_name + ' '
-                else:
-                    s += str(bot.db.get_player_name(player)) + ' '
+        for player, handle in players:
+            member = server.get_member(player)
+            if member:
+                s += member.display_name + ' '
+            else:
+                s += str(handle) + ' '
         
         s += '\n'
 
     s += '```'
-    await bot.client.send_message(message.channel, s)
+    return s
@@ -15,6 +15,10 @@ class Config:
         'verbosity':3,
         'require_ready':False,
         'auto_kick':True,
+        'reaction_rate':4,
+        'edit_delay':1,
+        'broadcast_delay':5,
+        'presence_delay':1,
         'modes':{
             'duel':1,
             '2v2':2,
@@ -77,11 +81,16 @@ class Config:
         self.verbosity = settings['verbosity']
         self.require_ready = settings['require_ready']
         self.auto_kick = settings['auto_kick']
+        self.reaction_rate = settings['reaction_rate']
+        self.edit_delay = settings['edit_delay']
+        self.broadcast_delay = settings['broadcast_delay']
+        self.presence_delay = settings['presence_delay']
         self.modes = settings['modes']
         self.teams = settings['teams']
         self.maps = settings['maps']
         self.emojis = settings['emojis']
         self.whitelist = settings['whitelist']
+        self.compile_whitelist()
 
     def __call__(self):
         return self.serial()
@@ -96,6 +105,10 @@ class Config:
             'verbosity':self.verbosity,
             'require_ready':self.require_ready,
             'auto_kick':self.auto_kick,
+            'reaction_rate':self.reaction_rate,
+            'edit_delay':self.edit_delay,
+            'broadcast_delay':self.broadcast_delay,
+            'presence_delay':self.presence_delay,
             'modes':self.modes,
             'teams':self.teams,
             'maps':self.maps,
@@ -105,6 +118,44 @@ class Config:
 
         return settings
 
+    def compile_whitelist(self):
+        """Builds whitelist_sets, command name -> frozenset of the
+        channel ids it's allowed in (empty if allowed everywhere), which
+        is what commands actually check against."""
+
+        self.whitelist_sets = {cmd: frozenset(chans) for cmd, chans in self.whitelist.items()}
+
+    def set_whitelist(self, cmd, channel_ids):
+        self.whitelist[cmd] = list(channel_ids)
+        self.whitelist_sets[cmd] = frozenset(channel_ids)
+
+    def migrate_whitelist(self, server):
+        """Whitelists used to hold channel names. Swaps any entry that
+        looks like a name (channel ids are all digits) for the id of the
+        text channel with that name. Names that don't match a channel are
+        kept as they are so the command stays restricted (no channel id
+        ever matches them) and get converted once the channel exists.
+
+        returns: bool (True if anything changed)
+        """
+
+        changed = False
+        for cmd, chans in self.whitelist.items():
+            ids = []
+            for name in chans:
+                if not name.isdigit():
+                    chan = discord.utils.find(lambda x: x.name == name and x.type == discord.ChannelType.text,
+                                              server.channels)
+                    if chan is not None:
+                        name = chan.id
+                        changed = True
+                ids.append(name)
+            self.whitelist[cmd] = ids
+
+        if changed:
+            self.compile_whitelist()
+        return changed
+
     def generate_maplist(self):
         maplist = {}
 
@@ -1,9 +1,33 @@
+import asyncio
+import re
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 class DatabaseAPI:
+    """Thin wrapper around sqlite3 for a single database file.
+
+    Connections are long-lived. Each thread that touches the database
+    gets its own connection, opened on first use with PRAGMAS already
+    applied and reused for every query after that. A connection that
+    errors out is dropped and reopened. Call close() on shutdown.
+    """
+
+    #applied once to every new connection
+    PRAGMAS = (
+        'PRAGMA foreign_keys = ON',
+        'PRAGMA synchronous = NORMAL',
+    )
+
+    #size of sqlite3's prepared statement cache for each connection
+    CACHED_STATEMENTS = 128
 
     def __init__(self, dbname):
         self.dbname = dbname
+        self._conns = {}
+        self._conns_lock = threading.Lock()
 
     def __touch(self, dbname):
         try:
@@ -13,30 +37,144 @@ class DatabaseAPI:
         finally:
             db.close()
 
+    def _connect(self):
+        db = sqlite3.connect(self.dbname, check_same_thread=False,
+                             cached_statements=self.CACHED_STATEMENTS)
+        for pragma in DatabaseAPI.PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def _connection(self):
+        """Returns the calling thread's connection, opening it if needed."""
+
+        key = threading.get_ident()
+        db = self._conns.get(key)
+        if db is None:
+            db = self._connect()
+            with self._conns_lock:
+                self._conns[key] = db
+        return db
+
+    def _reconnect(self):
+        """Drops the calling thread's connection so the next query opens
+        a fresh one."""
+
+        with self._conns_lock:
+            db = self._conns.pop(threading.get_ident(), None)
+        if db is not None:
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+
+    def _run(self, func):
+        """Calls func with the thread's connection. If the connection went
+        bad (closed, locked, I/O error...) it gets reopened and func is
+        retried once. Constraint violations are never retried.
+        """
+
+        try:
+            return func(self._connection())
+        except sqlite3.IntegrityError:
+            raise
+        except sqlite3.DatabaseError:
+            self._reconnect()
+            return func(self._connection())
+
+    def close(self):
+        with self._conns_lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+
+        for db in conns:
+            try:
+                db.close()
+            except sqlite3.Error as e:
+                print('DB Error: {}'.format(e))
+
+    @staticmethod
+    def _read_schema(filename):
+        """Splits a .sql file into its statements, skipping -- comment lines.
+
+        returns: list [str]
+        """
+
+        with open(filename, 'r') as f:
+            stripped_lines = []
+            for line in f.readlines():
+                if not line.startswith('--'): stripped_lines.append(line)
+            queries = ''.join(stripped_lines).split(';')
+
+        return [q for q in queries if q.strip()]
+
     def setup(self, filename):
         try:
-            with open(filename, 'r') as f:
-                stripped_lines = []
-                for line in f.readlines():
-                    if not line.startswith('--'): stripped_lines.append(line)
-                queries = ''.join(stripped_lines).split(';')
-
-                while '' in queries:
-                    queries.remove('')
+            queries = DatabaseAPI._read_schema(filename)
         except IOError as e:
             print('Error opening sql schema: {}'.format(e))
         else:
-            try:
-                db = sqlite3.connect(self.dbname)
-
+            def execute_schema(db):
                 with db:
                     c = db.cursor()
                     for q in queries:
                         c.execute(q)
+
+            try:
+                self._run(execute_schema)
             except sqlite3.Error as e:
                 print('Error executing sql schema: {}'.format(e))
-            else:
-                db.close()
+
+    def user_version(self):
+        return self._run(lambda db: db.execute('PRAGMA user_version').fetchone()[0])
+
+    def migrate(self, migrations):
+        """Brings the database schema up to date. migrations is an ordered
+        list of callables that take a cursor; applying migrations[i] takes
+        the database to version i + 1 (stored in PRAGMA user_version). Each
+        one runs in its own transaction together with the version bump, so
+        a failed migration leaves nothing behind. Failures are not retried,
+        the error is raised again so nothing runs on a half-migrated schema.
+        When the database is already current this is a single pragma read.
+
+        returns: int (number of migrations applied)
+        """
+
+        version = self.user_version()
+        applied = 0
+
+        for i in range(version, len(migrations)):
+            try:
+                self._apply_migration(migrations[i], i + 1)
+            except (sqlite3.Error, IOError) as e:
+                print('Migration to schema version {} failed: {}'.format(i + 1, e))
+                #don't reuse a connection that might be left in a bad state
+                self._reconnect()
+                raise
+            applied += 1
+
+        return applied
+
+    def _apply_migration(self, migration, new_version):
+        """Runs migration(cursor) and the user_version bump in one explicit
+        transaction. sqlite3 doesn't open a transaction before DDL on its
+        own (ALTER TABLE, CREATE...), so BEGIN/COMMIT are issued by hand
+        with the connection in autocommit mode while this runs.
+        """
+
+        db = self._connection()
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            db.execute('BEGIN')
+            try:
+                migration(db.cursor())
+                db.execute('PRAGMA user_version = {:d}'.format(new_version))
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.isolation_level = isolation_level
 
     def _db_get(self, query, *args):
         if not query.lower().startswith('select'):
@@ -45,39 +183,121 @@ class DatabaseAPI:
         
         select = []
         try:
-            db = sqlite3.connect(self.dbname)
-            c = db.cursor()
-
-            c.execute(query, args)
-            select = c.fetchall()
-
+            select = self._run(lambda db: db.execute(query, args).fetchall())
         except sqlite3.Error as e:
             print('DB Error: {}'.format(e))
-        else:
-            db.close()
 
         return select
 
     def _db_set(self, query, *args):
-        if not query.lower().startswith(('insert into', 'update', 'delete from')):
+        if not query.lower().startswith(('insert into', 'insert or replace into', 'update', 'delete from')):
             print('Bad query with db_set. Only INSERT, UPDATE, DELETE are allowed.')
             return False
 
-        try:
-            db = sqlite3.connect(self.dbname)
-
+        def execute(db):
             with db:
-                c = db.cursor()
-                c.execute("PRAGMA foreign_keys = ON",)
-                c.execute(query, args)
+                db.execute(query, args)
 
+        try:
+            self._run(execute)
         except sqlite3.Error as e:
             print('DB Error: {}'.format(e))
             return False
         else:
-            db.close()
             return True
 
+    def _db_transaction(self, func):
+        """Runs func(cursor) inside a single transaction so every
+        statement it executes is committed (or rolled back) together.
+        Returns whatever func returns, or None if the transaction failed.
+        """
+
+        def execute(db):
+            with db:
+                return func(db.cursor())
+
+        try:
+            return self._run(execute)
+        except sqlite3.Error as e:
+            print('DB Error: {}'.format(e))
+            return None
+
+class RecordCache:
+    """Thread-safe, bounded LRU cache of rows keyed by id.
+
+    Writers keep it current with put/update/evict after a write commits.
+    Readers that miss get a generation number from lookup() and hand it
+    back to fill() with the row they read; the row is only cached if no
+    write happened in between, so a slow read can't cache a stale row.
+
+    self.hits, self.misses (int)
+        lookup counters, for checking how well the cache is doing
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def lookup(self, key):
+        """returns: (record or None, generation)"""
+
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._records.move_to_end(key)
+            return record, self._generation
+
+    def fill(self, key, record, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._insert(key, record)
+
+    def put(self, key, record):
+        with self._lock:
+            self._generation += 1
+            self._insert(key, record)
+
+    def update(self, key, func):
+        """Replaces a cached record with func(record). Records that
+        aren't cached are left alone."""
+
+        with self._lock:
+            self._generation += 1
+            record = self._records.get(key)
+            if record is not None:
+                self._records[key] = func(record)
+
+    def evict(self, key):
+        with self._lock:
+            self._generation += 1
+            self._records.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._records.clear()
+
+    def _insert(self, key, record):
+        self._records[key] = record
+        self._records.move_to_end(key)
+        if len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+
+#player records are (handle, matches, wins, ruins)
+def _record_win(r): return (r[0], r[1] + 1, r[2] + 1, r[3])
+def _record_loss(r): return (r[0], r[1] + 1, r[2], r[3])
+def _record_ruin(r): return (r[0], r[1] + 1, r[2], r[3] + 1)
+
 class QCDB(DatabaseAPI):
 
     TPLAYERS = 'players'
@@ -86,6 +306,7 @@ class QCDB(DatabaseAPI):
     CMATCHES = 'matches'
     CWINS = 'wins'
     CRUINS = 'ruins'
+    CRATING = 'rating'
 
     TMATCHES = 'matches'
     TACTIVE = 'matches_active'
@@ -93,222 +314,619 @@ class QCDB(DatabaseAPI):
     CMODE = 'mode'
     CHOSTID = 'hostid'
     CWINNER = 'winner'
-
-    TTEAM1 = 'team1'
-    TTEAM2 = 'team2'
-    CTEAMID = 'id'
-    CSLOT0 = 'slot0'
-    CSLOT1 = 'slot1'
-    CSLOT2 = 'slot2'
-    CSLOT3 = 'slot3'
-
-    MAX_SLOTS = 4
-
-    def __init__(self, dbname):
+    CMSGID = 'msgid'
+
+    TROSTER = 'match_players'
+    CRMATCHID = 'match_id'
+    CRPLAYERID = 'player_id'
+    CTEAM = 'team'
+    CSLOT = 'slot'
+
+    TBANS = 'bans'
+    CBPLAYERID = 'player_id'
+    CEXPIRES = 'expires'
+    CMINUTES = 'minutes'
+    CREASON = 'reason'
+
+    #team names used by the bot -> team column values (same as matches.winner)
+    TEAMS = {'team1':1, 'team2':2}
+
+    #every query QCDB runs, built once from the table/column names above.
+    #the text of each statement never changes so sqlite's per-connection
+    #statement cache can reuse the prepared statement on every call.
+    SQL = {
+        #player
+        'get_player_record':
+            'SELECT {}, {}, {}, {} FROM {} WHERE {} == ?'
+            .format(CNAME, CMATCHES, CWINS, CRUINS, TPLAYERS, CPLAYERID),
+        'get_player_name':
+            'SELECT {} FROM {} WHERE {} == ?'
+            .format(CNAME, TPLAYERS, CPLAYERID),
+        #rating is kept up to date by every statement that changes
+        #matches/wins, so this is a range scan of the leaderboard index
+        'get_top_players':
+            'SELECT {0}, {1}, {2}, {3}, {4}, {5} AS power '
+            'FROM {6} ORDER BY {5} DESC, {4} ASC LIMIT ?'
+            .format(CPLAYERID, CNAME, CMATCHES, CWINS, CRUINS, CRATING, TPLAYERS),
+        'add_player':
+            'INSERT OR IGNORE INTO {} ({}, {}) VALUES (?, ?)'
+            .format(TPLAYERS, CPLAYERID, CNAME),
+        'remove_player':
+            'DELETE FROM {} WHERE {} == ?'
+            .format(TPLAYERS, CPLAYERID),
+        #rating = (matches * wins) / (matches - wins + 1), computed from
+        #the new matches/wins values (the right hand side sees the old ones)
+        'report_win':
+            'UPDATE {0} SET {1} = {1} + 1, {2} = {2} + 1, '
+            '{3} = (({1} + 1) * ({2} + 1)) / ({1} - {2} + 1) WHERE {4} == ?'
+            .format(TPLAYERS, CMATCHES, CWINS, CRATING, CPLAYERID),
+        'report_loss':
+            'UPDATE {0} SET {1} = {1} + 1, '
+            '{3} = (({1} + 1) * {2}) / ({1} - {2} + 2) WHERE {4} == ?'
+            .format(TPLAYERS, CMATCHES, CWINS, CRATING, CPLAYERID),
+        'report_ruin':
+            'UPDATE {0} SET {1} = {1} + 1, {2} = {2} + 1, '
+            '{4} = (({1} + 1) * {3}) / ({1} - {3} + 2) WHERE {5} == ?'
+            .format(TPLAYERS, CMATCHES, CRUINS, CWINS, CRATING, CPLAYERID),
+        'change_player_record':
+            'UPDATE {0} SET {1} = ?1, {2} = ?2, {3} = (?1 * ?2) / (?1 - ?2 + 1) WHERE {4} == ?3'
+            .format(TPLAYERS, CMATCHES, CWINS, CRATING, CPLAYERID),
+        'backfill_ratings':
+            'UPDATE {0} SET {3} = ({1} * {2}) / ({1} - {2} + 1)'
+            .format(TPLAYERS, CMATCHES, CWINS, CRATING),
+        'change_player_name':
+            'UPDATE {} SET {} = ? WHERE {} == ?'
+            .format(TPLAYERS, CNAME, CPLAYERID),
+
+        #match
+        'get_match':
+            'SELECT * FROM {} WHERE {} == ?'
+            .format(TMATCHES, CMATCHID),
+        'get_match_mode':
+            'SELECT {} FROM {} WHERE {} == ?'
+            .format(CMODE, TMATCHES, CMATCHID),
+        'get_active_match_status':
+            'SELECT {} FROM {} WHERE {} == ?'
+            .format(CWINNER, TACTIVE, CMATCHID),
+        'get_active_match_by_host':
+            'SELECT * FROM {} WHERE {} == ?'
+            .format(TACTIVE, CHOSTID),
+        'get_active_match_id_by_host':
+            'SELECT {} FROM {} WHERE {} == ?'
+            .format(CMATCHID, TACTIVE, CHOSTID),
+        'get_active_matches':
+            'SELECT {0}, {1}, {2}, {3}, {4} FROM {5} WHERE {3} < 1 ORDER BY {0} ASC'
+            .format(CMATCHID, CHOSTID, CMODE, CWINNER, CMSGID, TMATCHES),
+        'get_past_matches':
+            'SELECT * FROM {} WHERE {} > 0 ORDER BY {} DESC LIMIT ?'
+            .format(TMATCHES, CWINNER, CMATCHID),
+        #past matches with the winning team's players (and their handles),
+        #one row per winner ordered by match then slot
+        'get_recent_matches':
+            'SELECT m.{0}, m.{1}, m.{2}, r.{3}, p.{4} '
+            'FROM (SELECT {0}, {1}, {2} FROM {5} WHERE {2} > 0 ORDER BY {0} DESC LIMIT ?) AS m '
+            'LEFT JOIN {6} r ON r.{7} == m.{0} AND r.{8} == m.{2} '
+            'LEFT JOIN {9} p ON p.{10} == r.{3} '
+            'ORDER BY m.{0} DESC, r.{11} ASC'
+            .format(CMATCHID, CMODE, CWINNER, CRPLAYERID, CNAME, TMATCHES,
+                    TROSTER, CRMATCHID, CTEAM, TPLAYERS, CPLAYERID, CSLOT),
+        'create_match':
+            'INSERT INTO {} ({}, {}) VALUES (?, ?)'
+            .format(TMATCHES, CMODE, CHOSTID),
+        'update_match':
+            'UPDATE {} SET {} = ? WHERE {} == ? AND {} < 1'
+            .format(TMATCHES, CWINNER, CMATCHID, CWINNER),
+        'remove_match':
+            'DELETE FROM {} WHERE {} == ?'
+            .format(TMATCHES, CMATCHID),
+        'change_host':
+            'UPDATE {} SET {} = ? WHERE {} == ?'
+            .format(TMATCHES, CHOSTID, CMATCHID),
+        'change_match_message':
+            'UPDATE {} SET {} = ? WHERE {} == ?'
+            .format(TMATCHES, CMSGID, CMATCHID),
+        'change_host_checked':
+            'UPDATE {0} SET {1} = ? WHERE {2} == ? AND EXISTS '
+            '(SELECT 1 FROM {3} WHERE {4} == ? AND {5} == ?)'
+            .format(TMATCHES, CHOSTID, CMATCHID, TROSTER, CRMATCHID, CRPLAYERID),
+
+        #roster
+        'get_roster':
+            'SELECT {}, {}, {} FROM {} WHERE {} == ?'
+            .format(CRPLAYERID, CTEAM, CSLOT, TROSTER, CRMATCHID),
+        'get_team':
+            'SELECT {} FROM {} WHERE {} == ? AND {} == ? ORDER BY {} ASC'
+            .format(CRPLAYERID, TROSTER, CRMATCHID, CTEAM, CSLOT),
+        'get_roster_slot':
+            'SELECT {} FROM {} WHERE {} == ? AND {} == ?'
+            .format(CSLOT, TROSTER, CRMATCHID, CRPLAYERID),
+        'add_to_roster':
+            'INSERT INTO {} ({}, {}, {}, {}) VALUES (?, ?, ?, ?)'
+            .format(TROSTER, CRMATCHID, CRPLAYERID, CTEAM, CSLOT),
+        #puts a player in the first free slot (below ?4) of their team
+        'add_to_roster_free_slot':
+            'INSERT INTO {0} ({1}, {2}, {3}, {4}) '
+            'SELECT ?1, ?2, ?3, free.{4} FROM '
+            '(SELECT 0 AS {4} UNION SELECT {4} + 1 FROM {0} WHERE {1} == ?1 AND {3} == ?3) AS free '
+            'WHERE free.{4} < ?4 AND free.{4} NOT IN (SELECT {4} FROM {0} WHERE {1} == ?1 AND {3} == ?3) '
+            'ORDER BY free.{4} ASC LIMIT 1'
+            .format(TROSTER, CRMATCHID, CRPLAYERID, CTEAM, CSLOT),
+        'remove_from_roster':
+            'DELETE FROM {} WHERE {} == ? AND {} == ?'
+            .format(TROSTER, CRMATCHID, CRPLAYERID),
+        'clear_roster':
+            'DELETE FROM {} WHERE {} == ?'
+            .format(TROSTER, CRMATCHID),
+
+        #bans, expires is a unix timestamp
+        'get_bans':
+            'SELECT {}, {}, {}, {} FROM {} WHERE {} > ?'
+            .format(CBPLAYERID, CEXPIRES, CMINUTES, CREASON, TBANS, CEXPIRES),
+        'add_ban':
+            'INSERT OR REPLACE INTO {} ({}, {}, {}, {}) VALUES (?, ?, ?, ?)'
+            .format(TBANS, CBPLAYERID, CEXPIRES, CMINUTES, CREASON),
+        'remove_ban':
+            'DELETE FROM {} WHERE {} == ?'
+            .format(TBANS, CBPLAYERID),
+        'remove_expired_bans':
+            'DELETE FROM {} WHERE {} <= ?'
+            .format(TBANS, CEXPIRES),
+    }
+
+    #schema versions in order, the database's user_version is how many of
+    #these have been applied. never edit or reorder these, add new ones
+    #to the end. each takes a cursor and runs inside a transaction.
+    MIGRATIONS = (
+        '_create_schema',
+        '_convert_team_tables',
+        '_add_player_rating',
+        '_add_match_message',
+        '_create_bans',
+    )
+
+    def __init__(self, dbname, cache_size=512):
         super().__init__(dbname)
+        self._schema = None
+        self.player_cache = RecordCache(cache_size)
+
+    def setup(self, filename):
+        """Creates or upgrades the database. filename is the baseline
+        schema, which is only read for a brand new (or pre-versioning)
+        database. Every statement in QCDB.SQL is validated each time,
+        current database or not, so a bad edit to one shows up on the
+        next restart.
+        """
+
+        self._schema = filename
+        if self.user_version() == 0:
+            #WAL so readers don't block the writer. the journal mode can't
+            #be changed inside a transaction so it isn't part of a migration
+            self._run(lambda db: db.execute('PRAGMA journal_mode = WAL').fetchone())
+
+        migrations = [getattr(self, name) for name in QCDB.MIGRATIONS]
+        self.migrate(migrations)
+        self.validate_statements()
+
+    def validate_statements(self):
+        """Compiles every statement in QCDB.SQL against the current schema
+        (without running it) so a query that references a missing table or
+        column is reported on startup instead of the first time it's used.
+
+        returns: bool (True if every statement compiled)
+        """
+
+        ok = True
+        db = self._connection()
+        for name, query in QCDB.SQL.items():
+            #unbound parameters are null, which is fine for EXPLAIN
+            try:
+                db.execute('EXPLAIN ' + query, [None] * QCDB._count_params(query))
+            except sqlite3.Error as e:
+                print('Bad statement \"{}\": {}'.format(name, e))
+                ok = False
+        return ok
+
+    @staticmethod
+    def _count_params(query):
+        numbered = [int(n) for n in re.findall(r'\?(\d+)', query)]
+        if numbered:
+            return max(numbered)
+        return query.count('?')
+
+    #----------
+    #Migrations
+    #----------
+
+    def _create_schema(self, c):
+        """Baseline: every table in the schema file. Uses IF NOT EXISTS so it
+        also works on databases from before schema versioning."""
+
+        for q in DatabaseAPI._read_schema(self._schema):
+            c.execute(q)
+
+    def _convert_team_tables(self, c):
+        """Moves rosters out of the old team1/team2 tables (fixed slot0-slot3
+        columns) into match_players and drops them. Does nothing on
+        databases that were created with match_players.
+        """
+
+        insert_q = ('INSERT OR IGNORE INTO {0} ({1}, {2}, {3}, {4}) '
+                    'SELECT id, slot{{0}}, ?, ? FROM {{1}} WHERE slot{{0}} IS NOT NULL'
+                    .format(QCDB.TROSTER, QCDB.CRMATCHID, QCDB.CRPLAYERID, QCDB.CTEAM, QCDB.CSLOT))
+
+        c.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name IN ('team1', 'team2')")
+        tables = [row[0] for row in c.fetchall()]
+
+        for table in tables:
+            for slot in range(4):
+                c.execute(insert_q.format(slot, table), (QCDB.TEAMS[table], slot))
+            c.execute('DROP TABLE {}'.format(table))
+
+    def _add_player_rating(self, c):
+        """Adds the stored rating column to databases created before it
+        existed (filling it in for every player) and the leaderboard index.
+        """
+
+        columns = [row[1] for row in c.execute('PRAGMA table_info({})'.format(QCDB.TPLAYERS))]
+        if QCDB.CRATING not in columns:
+            c.execute('ALTER TABLE {} ADD COLUMN {} INTEGER DEFAULT 0 NOT NULL'
+                      .format(QCDB.TPLAYERS, QCDB.CRATING))
+            c.execute(QCDB.SQL['backfill_ratings'])
+
+        c.execute('CREATE INDEX IF NOT EXISTS players_leaderboard ON {} ({} DESC, {} ASC)'
+                  .format(QCDB.TPLAYERS, QCDB.CRATING, QCDB.CRUINS))
+
+    def _add_match_message(self, c):
+        """Adds the column that remembers which discord message shows each
+        lobby, so lobbies can be picked back up after a restart."""
+
+        columns = [row[1] for row in c.execute('PRAGMA table_info({})'.format(QCDB.TMATCHES))]
+        if QCDB.CMSGID not in columns:
+            c.execute('ALTER TABLE {} ADD COLUMN {} TEXT'.format(QCDB.TMATCHES, QCDB.CMSGID))
+
+    def _create_bans(self, c):
+        """Adds the table that keeps cooldowns across restarts."""
+
+        c.execute('CREATE TABLE IF NOT EXISTS {} ('
+                  '{} TEXT PRIMARY KEY, {} INTEGER NOT NULL, {} INTEGER NOT NULL, '
+                  '{} TEXT DEFAULT "" NOT NULL) WITHOUT ROWID'
+                  .format(QCDB.TBANS, QCDB.CBPLAYERID, QCDB.CEXPIRES, QCDB.CMINUTES, QCDB.CREASON))
+
+    def backfill_ratings(self):
+        """Recomputes the rating of every player, for when the players
+        table was edited by hand."""
+
+        self._db_set(QCDB.SQL['backfill_ratings'])
 
     #------
     #Player
     #------
     def get_player_record(self, player_id):
-        fill_ins = (QCDB.CNAME, QCDB.CMATCHES, QCDB.CWINS, QCDB.CRUINS, QCDB.TPLAYERS, QCDB.CPLAYERID)
-        get = self._db_get('SELECT {}, {}, {}, {} FROM {} WHERE {} == ?'.format(*fill_ins), player_id)
+        record, generation = self.player_cache.lookup(player_id)
+        if record is not None:
+            return record
+
+        get = self._db_get(QCDB.SQL['get_player_record'], player_id)
 
         if not get:
             return []
+        self.player_cache.fill(player_id, get[0], generation)
         return get[0]
 
     def get_player_name(self, player_id):
-        fill_ins = (QCDB.CNAME, QCDB.TPLAYERS, QCDB.CPLAYERID)
-        get = self._db_get('SELECT {} FROM {} WHERE {} == ?'.format(*fill_ins), player_id)
+        record = self.get_player_record(player_id)
 
-        if not get:
+        if not record:
             return []
-        return get[0][0]
+        return record[0]
 
     def get_top_players(self, limit):
-        fill_ins = (QCDB.CPLAYERID, QCDB.CNAME, QCDB.CMATCHES, QCDB.CWINS, QCDB.CRUINS, QCDB.TPLAYERS)
-        
         lim = 5 if limit > 10 or limit < 1 else limit
-        return self._db_get(
-            'SELECT {0}, {1}, {2}, {3}, {4}, (({2} * {3}) / ({2} - {3} + 1)) AS power FROM {5} ORDER BY power DESC, {4} ASC LIMIT ?'
-            .format(*fill_ins), lim
-            )
+        return self._db_get(QCDB.SQL['get_top_players'], lim)
 
     def add_player(self, player_id, name):
-        fill_ins = (QCDB.TPLAYERS, QCDB.CPLAYERID, QCDB.CNAME)
-        self._db_set('INSERT INTO {} ({}, {}) VALUES (?, ?)'.format(*fill_ins), player_id, name)
+        """Adds the player unless they're already in the table (two
+        actions from a new player can both try to add them)."""
+
+        def add(c):
+            c.execute(QCDB.SQL['add_player'], (player_id, name))
+            return c.rowcount
+
+        if self._db_transaction(add):
+            self.player_cache.put(player_id, (name, 0, 0, 0))
 
     def remove_player(self, player_id):
-        fill_ins = (QCDB.TPLAYERS, QCDB.CPLAYERID)
-        self._db_set('DELETE FROM {} WHERE {} == ?'.format(*fill_ins), player_id)
+        self._db_set(QCDB.SQL['remove_player'], player_id)
+        self.player_cache.evict(player_id)
 
     def report_match(self, player_id, bWin):
-        if bWin:
-            fill_ins = (QCDB.TPLAYERS, QCDB.CMATCHES, QCDB.CMATCHES, QCDB.CWINS, QCDB.CWINS, QCDB.CPLAYERID)
-            q = 'UPDATE {} SET {} = {} + 1, {} = {} + 1 WHERE {} == ?'.format(*fill_ins)
-        else:
-            fill_ins = (QCDB.TPLAYERS, QCDB.CMATCHES, QCDB.CMATCHES, QCDB.CPLAYERID)
-            q = 'UPDATE {} SET {} = {} + 1 WHERE {} == ?'.format(*fill_ins)
-        
-        self._db_set(q, player_id)
+        if self._db_set(QCDB.SQL['report_win' if bWin else 'report_loss'], player_id):
+            self.player_cache.update(player_id, _record_win if bWin else _record_loss)
 
     def report_ruined_match(self, player_id):
-        fill_ins = (QCDB.TPLAYERS, QCDB.CMATCHES, QCDB.CRUINS, QCDB.CPLAYERID)
-        self._db_set('UPDATE {0} SET {1} = {1} + 1, {2} = {2} + 1 WHERE {3} == ?'.format(*fill_ins), player_id)
+        if self._db_set(QCDB.SQL['report_ruin'], player_id):
+            self.player_cache.update(player_id, _record_ruin)
 
     def change_player_record(self, player_id, matches, wins):
-        fill_ins = (QCDB.TPLAYERS, QCDB.CMATCHES, QCDB.CWINS, QCDB.CPLAYERID)
-        self._db_set('UPDATE {} SET {} = ?, {} = ? WHERE {} == ?'.format(*fill_ins), matches, wins, player_id)
+        if self._db_set(QCDB.SQL['change_player_record'], matches, wins, player_id):
+            self.player_cache.update(player_id, lambda r: (r[0], matches, wins, r[3]))
 
     def change_player_name(self, player_id, name):
-        fill_ins = (QCDB.TPLAYERS, QCDB.CNAME, QCDB.CPLAYERID)
-        self._db_set('UPDATE {} SET {} = ? WHERE {} == ?'.format(*fill_ins), name, player_id)
+        if self._db_set(QCDB.SQL['change_player_name'], name, player_id):
+            self.player_cache.update(player_id, lambda r: (name, r[1], r[2], r[3]))
 
     #-----
     #Match
     #-----
 
     def get_match(self, match_id):
-        fill_ins = (QCDB.TMATCHES, QCDB.CMATCHID)
-        get = self._db_get('SELECT * FROM {} WHERE {} == ?'.format(*fill_ins), match_id)
+        get = self._db_get(QCDB.SQL['get_match'], match_id)
         
         if not get:
             return []
         return get[0]
 
     def get_match_mode(self, match_id):
-        fill_ins = (QCDB.CMODE, QCDB.TMATCHES, QCDB.CMATCHID)
-        get = self._db_get('SELECT {} FROM {} WHERE {} == ?'.format(*fill_ins), match_id)
+        get = self._db_get(QCDB.SQL['get_match_mode'], match_id)
         
         if not get:
             return []
         return get[0][0]
 
     def get_active_match_status(self, match_id):
-        fill_ins = (QCDB.CWINNER, QCDB.TACTIVE, QCDB.CMATCHID)
-        get = self._db_get('SELECT {} FROM {} WHERE {} == ?'.format(*fill_ins), match_id)
+        get = self._db_get(QCDB.SQL['get_active_match_status'], match_id)
         
         if not get:
             return []
         return get[0][0]
 
     def get_active_match_by_host(self, host_id):
-        fill_ins = (QCDB.TACTIVE, QCDB.CHOSTID)
-        get = self._db_get('SELECT * FROM {} WHERE {} == ?'.format(*fill_ins), host_id)
+        get = self._db_get(QCDB.SQL['get_active_match_by_host'], host_id)
         
         if not get:
             return []
         return get[0]
 
     def get_active_match_id_by_host(self, host_id):
-        fill_ins = (QCDB.CMATCHID, QCDB.TACTIVE, QCDB.CHOSTID)
-        get = self._db_get('SELECT {} FROM {} WHERE {} == ?'.format(*fill_ins), host_id)
+        get = self._db_get(QCDB.SQL['get_active_match_id_by_host'], host_id)
         
         if not get:
             return []
         return get[0][0]
 
     def get_active_matches(self):
-        fill_ins = (QCDB.TACTIVE, QCDB.CMATCHID)
-        return self._db_get('SELECT * FROM {} ORDER BY {} ASC'.format(*fill_ins))
+        """returns: list [(match id, host id, mode, status, lobby message id)]"""
+
+        return self._db_get(QCDB.SQL['get_active_matches'])
 
     def get_past_matches(self, limit):
-        fill_ins = (QCDB.TMATCHES, QCDB.CWINNER, QCDB.CMATCHID)
+        lim = 5 if limit > 10 or limit < 1 else limit
+        return self._db_get(QCDB.SQL['get_past_matches'], lim)
+
+    def get_recent_matches(self, limit):
+        """Past matches and who won them in one query.
+
+        returns: list [(match id, mode, winning team, [(player id, handle)])]
+        """
 
         lim = 5 if limit > 10 or limit < 1 else limit
-        return self._db_get('SELECT * FROM {} WHERE {} > 0 ORDER BY {} DESC LIMIT ?'.format(*fill_ins), lim)
+
+        matches = []
+        for match_id, mode, winner, player_id, handle in self._db_get(QCDB.SQL['get_recent_matches'], lim):
+            if not matches or matches[-1][0] != match_id:
+                matches.append((match_id, mode, winner, []))
+            if player_id:
+                matches[-1][3].append((player_id, handle))
+        return matches
 
     def create_match(self, host_id, mode):
-        fill_ins = (QCDB.TMATCHES, QCDB.CMODE, QCDB.CHOSTID)
-        self._db_set('INSERT INTO {} ({}, {}) VALUES (?, ?)'.format(*fill_ins), mode, host_id)
+        """Creates the match and puts the host in the first slot of team1
+        in one transaction.
+
+        returns: int (new match id) or None if it failed
+        """
+
+        def create(c):
+            c.execute(QCDB.SQL['create_match'], (mode, host_id))
+            match_id = c.lastrowid
+            c.execute(QCDB.SQL['add_to_roster'], (match_id, host_id, QCDB.TEAMS['team1'], 0))
+            return match_id
+
+        return self._db_transaction(create)
+
+    def finalize_match(self, match_id, winners, losers, winning_team):
+        """Sets the winner of a match and reports the result for every
+        player in one transaction. Nothing is written if the match
+        already has a winner.
 
-        match_id = self.get_active_match_id_by_host(host_id)
-        self._create_teams(match_id, host_id)
-        return match_id
+        returns: bool (True if the match was finalized)
+        """
+
+        def finalize(c):
+            c.execute(QCDB.SQL['update_match'], (winning_team, match_id))
+            if c.rowcount < 1:
+                return False
+
+            c.executemany(QCDB.SQL['report_win'], [(p,) for p in winners])
+            c.executemany(QCDB.SQL['report_loss'], [(p,) for p in losers])
+            return True
+
+        finalized = bool(self._db_transaction(finalize))
+        if finalized:
+            for p in winners:
+                self.player_cache.update(p, _record_win)
+            for p in losers:
+                self.player_cache.update(p, _record_loss)
+        return finalized
 
     def update_match(self, match_id, winner):
-        fill_ins = (QCDB.TMATCHES, QCDB.CWINNER, QCDB.CMATCHID, QCDB.CWINNER)
-        self._db_set('UPDATE {} SET {} == ? WHERE {} == ? AND {} < 1'.format(*fill_ins), winner, match_id)
+        self._db_set(QCDB.SQL['update_match'], winner, match_id)
 
     def remove_match(self, match_id):
-        fill_ins = (QCDB.TMATCHES, QCDB.CMATCHID)
-        self._db_set('DELETE FROM {} WHERE {} == ?'.format(*fill_ins), match_id)
+        self._db_set(QCDB.SQL['remove_match'], match_id)
 
     def change_host(self, match_id, player_id):
-        players_in_match = self.get_all_players_in_match(match_id)
+        #only players in the match can become host
+        self._db_set(QCDB.SQL['change_host_checked'], player_id, match_id, match_id, player_id)
 
-        for player in players_in_match:
-            if player == player_id:
-                self._db_set('UPDATE {} SET {} == ? WHERE {} == ?'.format(QCDB.TMATCHES, QCDB.CHOSTID, QCDB.CMATCHID), player_id, match_id)
+    def set_match_message(self, match_id, msg_id):
+        self._db_set(QCDB.SQL['change_match_message'], msg_id, match_id)
 
-    def get_all_players_in_match(self, match_id):
-        p1 = self.get_players_on_team(match_id, 'team1')
-        p2 = self.get_players_on_team(match_id, 'team2')
+    #------
+    #Roster
+    #------
 
-        if p1 and p2:
-            return [player for player in (p1 + p2)]
-        else:
-            return []
+    def get_all_players_in_match(self, match_id, team_size):
+        """Returns the lobby as a list of player ids: team1 slots followed
+        by team2 slots, team_size each, with None in empty slots.
+        """
+
+        get = self._db_get(QCDB.SQL['get_roster'], match_id)
+
+        players = [None] * (team_size * 2)
+        for player_id, team, slot in get:
+            if slot < team_size:
+                players[slot + (team - 1) * team_size] = player_id
+        return players
 
     def get_players_on_team(self, match_id, team):
-        if team in (QCDB.TTEAM1, QCDB.TTEAM2):
-            fill_ins = (QCDB.CSLOT0, QCDB.CSLOT1, QCDB.CSLOT2, QCDB.CSLOT3, team, QCDB.CMATCHID)
-            get = self._db_get('SELECT {}, {}, {}, {} FROM {} WHERE {} == ?'.format(*fill_ins), match_id)
-                    
-            if not get:
-                return []
-            return get[0]
+        if team in QCDB.TEAMS:
+            get = self._db_get(QCDB.SQL['get_team'], match_id, QCDB.TEAMS[team])
+            return [row[0] for row in get]
         else:
             return []
 
     def add_player_to_match(self, match_id, player_id, team, maxplayers):
-        players_in_match = self.get_all_players_in_match(match_id)
+        """Puts the player in the first empty slot of their team.
 
-        slot_added = -1
-        #make sure we cant add the player twice
-        for player in players_in_match:
-            if player == player_id:
-                return
-        
-        players_on_team = self.get_players_on_team(match_id, team)
+        returns: int (slot on the team or -1 if the team is full)
+        """
+
+        if team not in QCDB.TEAMS:
+            return -1
 
-        #add player to first empty (None) slot if maxplayers hasn't been surpassed
-        if players_on_team:
-            for i, player in enumerate(players_on_team):
-                if i > (maxplayers - 1):
-                    break
-                if player is None:
-                    self._db_set('UPDATE {} SET {} = ? WHERE {} == ?'.format(team, 'slot' + str(i), QCDB.CMATCHID), player_id, match_id)
-                    slot_added = i
-                    break
+        def add(c):
+            c.execute(QCDB.SQL['add_to_roster_free_slot'], (match_id, player_id, QCDB.TEAMS[team], maxplayers))
+            if c.rowcount < 1:
+                return -1
+            return c.execute(QCDB.SQL['get_roster_slot'], (match_id, player_id)).fetchone()[0]
 
-        return slot_added
+        slot = self._db_transaction(add)
+        return -1 if slot is None else slot
 
     def remove_player_from_match(self, match_id, player_id):
-        success = False
-        players_in_match = self.get_all_players_in_match(match_id)
+        return self._db_set(QCDB.SQL['remove_from_roster'], match_id, player_id)
+
+    def drop_player(self, match_id, player_id, new_host=None, ruined=False, loss=False):
+        """Removes a player from a match along with everything that comes
+        with it (handing off host, penalizing the player) in one transaction.
+
+        args:
+            new_host: player id that takes over as host, if any
+            ruined: report the match as ruined by the player (left a live game)
+            loss: report the match as a loss for the player (kicked from a live game)
+        """
+
+        def drop(c):
+            c.execute(QCDB.SQL['remove_from_roster'], (match_id, player_id))
+            if c.rowcount < 1:
+                return False
+
+            if new_host:
+                c.execute(QCDB.SQL['change_host'], (new_host, match_id))
+            if ruined:
+                c.execute(QCDB.SQL['report_ruin'], (player_id,))
+            if loss:
+                c.execute(QCDB.SQL['report_loss'], (player_id,))
+            return True
 
-        for i, player in enumerate(players_in_match):
-            if player == player_id:
-                if i < (len(players_in_match) // 2):
-                    success = self._db_set('UPDATE {} SET {} = null WHERE {} == ?'.format(QCDB.TTEAM1, 'slot' + str(i), QCDB.CMATCHID), match_id)
-                else:
-                    success = self._db_set('UPDATE {} SET {} = null WHERE {} == ?'.format(QCDB.TTEAM2, 'slot' + str(i - (len(players_in_match) // 2)), QCDB.CMATCHID), match_id)
-                break
+        dropped = bool(self._db_transaction(drop))
+        if dropped and ruined:
+            self.player_cache.update(player_id, _record_ruin)
+        if dropped and loss:
+            self.player_cache.update(player_id, _record_loss)
+        return dropped
+
+    def set_roster(self, match_id, players):
+        """Rewrites the whole lobby (same layout as get_all_players_in_match)
+        in one transaction. Used after players are moved around."""
+
+        team_size = len(players) // 2
+        rows = []
+        for i, player in enumerate(players):
+            if player:
+                team = 1 if i < team_size else 2
+                rows.append((match_id, player, team, i % team_size))
+
+        def replace(c):
+            c.execute(QCDB.SQL['clear_roster'], (match_id,))
+            c.executemany(QCDB.SQL['add_to_roster'], rows)
+            return True
 
-        return success
+        return bool(self._db_transaction(replace))
 
-    def change_players_on_team(self, match_id, team, new):
-        if team in (QCDB.TTEAM1, QCDB.TTEAM2):
-            fill_ins = (team, QCDB.CSLOT0, QCDB.CSLOT1, QCDB.CSLOT2, QCDB.CSLOT3, QCDB.CMATCHID)
-            self._db_set('UPDATE {} SET {} = ?, {} = ?, {} = ?, {} = ? WHERE {} == ?'.format(*fill_ins), new[0], new[1], new[2], new[3], match_id)
+    #----
+    #Bans
+    #----
 
-    #-----
-    #Teams
-    #-----
+    def get_bans(self, now):
+        """returns: list [(player id, expires, minutes, reason)] of bans
+        that haven't expired by now"""
+
+        return self._db_get(QCDB.SQL['get_bans'], now)
+
+    def add_ban(self, player_id, expires, minutes, reason):
+        self._db_set(QCDB.SQL['add_ban'], player_id, expires, minutes, reason)
+
+    def remove_ban(self, player_id):
+        self._db_set(QCDB.SQL['remove_ban'], player_id)
+
+    def remove_expired_bans(self, now):
+        self._db_set(QCDB.SQL['remove_expired_bans'], now)
+
+
+class AsyncQCDB:
+    """Awaitable facade over a QCDB so queries never block the event loop.
+
+    Every QCDB method is exposed as a coroutine of the same name. Writes
+    (and anything that both reads and writes) run on one dedicated thread
+    so they are applied in the order they were awaited. Plain reads
+    (get_*) run on a small pool of reader threads, each of which holds
+    its own sqlite connection.
+
+    self.sync (QCDB)
+        the wrapped database, for the few places that have to
+        call it directly
+    """
+
+    def __init__(self, qcdb, loop=None, readers=2):
+        self.sync = qcdb
+        self.loop = loop
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._readers = ThreadPoolExecutor(max_workers=readers)
+
+    def __getattr__(self, name):
+        func = getattr(self.sync, name)
+        if name.startswith('_') or not callable(func):
+            return func
+
+        executor = self._readers if name.startswith('get_') else self._writer
+
+        async def call(*args, **kwargs):
+            loop = self.loop or asyncio.get_event_loop()
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+        #cache the wrapper so the next lookup skips __getattr__
+        setattr(self, name, call)
+        return call
+
+    async def close(self):
+        """Waits for queued queries to finish then closes every connection."""
+
+        loop = self.loop or asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._shutdown)
 
-    def _create_teams(self, match_id, host_id):
-        #create rows in team1, team2 tables and add the host to the first team
-        self._db_set('INSERT INTO {} ({}, {}) VALUES (?, ?)'.format(QCDB.TTEAM1, QCDB.CTEAMID, QCDB.CSLOT0), match_id, host_id)
-        self._db_set('INSERT INTO {} ({}) VALUES (?)'.format(QCDB.TTEAM2, QCDB.CTEAMID), match_id)
\ No newline at end of file
+    def _shutdown(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.sync.close()
@@ -0,0 +1,44 @@
+class Dispatcher:
+    """Finds the command a message is calling.
+
+    Most messages aren't commands, so those are turned away by a single
+    startswith on the prefix before anything is split or looked up. The
+    table maps every name and alias to its command and is only rebuilt
+    when the commands are reloaded or the prefix changes.
+
+    self.prefix (str)
+        the bot's command prefix the table was built for
+
+    self.table (dict, key: str, val: command)
+        command name or alias (without the prefix) -> command
+    """
+
+    def __init__(self, prefix, cmds):
+        self.prefix = ''
+        self.table = {}
+        self.rebuild(prefix, cmds)
+
+    def rebuild(self, prefix, cmds):
+        table = {}
+        for name, cmd in cmds.items():
+            table[name] = cmd
+        #real names win over aliases
+        for cmd in cmds.values():
+            for alias in getattr(cmd, 'aliases', ()):
+                table.setdefault(alias, cmd)
+
+        self.prefix = prefix
+        self.table = table
+
+    def match(self, content):
+        """returns: (command, content split on spaces) or (None, None)
+        if the message isn't a command"""
+
+        if not content.startswith(self.prefix):
+            return None, None
+
+        split_text = content.split(' ')
+        cmd = self.table.get(split_text[0][len(self.prefix):])
+        if cmd is None:
+            return None, None
+        return cmd, split_text
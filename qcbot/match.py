@@ -1,99 +1,208 @@
-from .database import QCDB
+from collections import namedtuple
+
+#all that's kept of a lobby's discord message. edit_message, add_reaction
+#and delete_message only need the id and the channel it's in
+MessageRef = namedtuple('MessageRef', 'id channel')
+
+class Match:
+    """Holds match info.
+
+    Fields are slots instead of dict keys so lobbies stay small, and the
+    player sets (ready, mutinies, needsub) are sets so checking if someone
+    is in them doesn't scan a list. Fields can still be read and written
+    like a dict (match['host']).
+
+    Every change bumps self.version and str() is cached for the version it
+    was rendered at, so showing a lobby that hasn't changed costs nothing.
+    When it has changed, each roster line is only rebuilt if the player in
+    that slot or their tag (host, ready, needs sub) changed.
+    Assigning a field bumps it automatically, but the roster list and the
+    player sets have to be changed through the methods below (set_player,
+    set_ready, etc.) or followed by touch().
+
+    self.players (list [str])
+        the roster, always max_players long with None in empty slots.
+        team1 slots come first, then team2
+
+    self.message (qcbot.match.MessageRef)
+        the lobby's message in the pug channel or None before it's sent
+
+    self.version (int)
+        counts changes to anything that shows up in the lobby
+    """
+
+    __slots__ = (
+        'id', 'host', 'mode', 'players', 'status',
+        'mutinies', 'ready', 'needsub', 'map', 'note', 'message',
+        'max_players_team', 'max_players', 'team1_name', 'team2_name',
+        'version', '_rendered', '_slot_labels', '_fragments',
+    )
+
+    #fields that don't change what the lobby looks like
+    UNVERSIONED = frozenset(('message', 'version', '_rendered', '_slot_labels', '_fragments'))
 
-class Match(dict):
-    """Dict that holds match info."""
-    
     #match status codes
     LIVE = -1 #in-progress
     LOBBY = 0 #waiting to start
     W_TOP = 1 #match over, top team won
     W_BOT = 2 #match over, bottom team won
 
-    def __init__(self, conf, match_id, host, mode, players=[], status=0, note='', *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self['id'] = match_id
-        self['host'] = host
-        self['mode'] = mode
-        self['players'] = players
-        self['status'] = status
-
-        self['mutinies'] = []
-        self['ready'] = []
-        self['needsub'] = []
-        self['map'] = ''
-        self['note'] = note
+    def __init__(self, conf, match_id, host, mode, players=None, status=0, note='', **kwargs):
+        self.version = 0
+        self._rendered = (-1, '')
 
         self.max_players_team = conf.modes[mode]
         self.max_players = self.max_players_team * 2
         self.team1_name = conf.teams['team1'][0]
         self.team2_name = conf.teams['team2'][0]
 
-        if kwargs:
-            for key, val in kwargs.items():
-                self[key] = val
+        self.id = match_id
+        self.host = host
+        self.mode = mode
+        self.players = [None] * self.max_players
+        for i, player in enumerate((players or [])[:self.max_players]):
+            self.players[i] = player
+        self.status = status
 
-    #def __getattr__(self, attr):
-    #    return self.get(attr)
+        self.mutinies = set()
+        self.ready = set()
+        self.needsub = set()
+        self.map = ''
+        self.note = note
+        self.message = None
 
-    def __str__(self):
-        body = ''
-        header = ''
-        num_players = len([x for x in self['players'] if x])
+        #the part of each roster line that never changes, and the last
+        #line built for each slot as (player, tag, line)
+        self._slot_labels = ['        {}. '.format(i + 1) for i in range(self.max_players)]
+        self._fragments = [(None, '', label + '\n') for label in self._slot_labels]
+
+        for key, val in kwargs.items():
+            self[key] = val
+
+    def __setattr__(self, key, val):
+        object.__setattr__(self, key, val)
+        if key not in Match.UNVERSIONED:
+            object.__setattr__(self, 'version', self.version + 1)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        if key not in Match.__slots__:
+            raise KeyError(key)
+        setattr(self, key, val)
+
+    def touch(self):
+        """Marks the lobby as changed after editing players or one of
+        the player sets directly."""
+
+        self.version += 1
 
-        team1 = self['players'][:self.max_players_team]
-        team2 = self['players'][QCDB.MAX_SLOTS:(QCDB.MAX_SLOTS + self.max_players_team)]
+    def set_player(self, ind, player_id):
+        self.players[ind] = player_id
+        self.version += 1
 
-        body += '\U0001F535 {}\n'.format(self.team1_name)
-        for i, player in enumerate(team1):
+    def set_ready(self, player_id, ready):
+        if ready:
+            self.ready.add(player_id)
+        else:
+            self.ready.discard(player_id)
+        self.version += 1
+
+    def set_mutiny(self, player_id, vote):
+        if vote:
+            self.mutinies.add(player_id)
+        else:
+            self.mutinies.discard(player_id)
+        self.version += 1
+
+    def forget(self, player_id):
+        """Takes a player that left out of every player set."""
+
+        self.ready.discard(player_id)
+        self.mutinies.discard(player_id)
+        self.needsub.discard(player_id)
+        self.version += 1
+
+    def clear_ready(self):
+        self.ready.clear()
+        self.version += 1
+
+    def clear_mutinies(self):
+        self.mutinies.clear()
+        self.version += 1
+
+    def __str__(self):
+        version, text = self._rendered
+        if version != self.version:
+            text = self._render()
+            self._rendered = (self.version, text)
+        return text
+
+    def _player_fragment(self, ind, player):
+        tag = self._player_tag(ind, player)
+        cached_player, cached_tag, line = self._fragments[ind]
+        if player != cached_player or tag != cached_tag:
             if player:
-                playername = '<@' + player + '>'
-
-                if player == self['host']:
-                    playername += '\U0001F451'
-                elif player in self['ready']:
-                    playername += ' <- ready!'
-                elif player in self['needsub']:
-                    playername += ' <- NEEDS SUB!!'
+                line = self._slot_labels[ind] + '<@' + player + '>' + tag + '\n'
             else:
-                playername = ''
-            body += '        ' + str(i + 1) + '. ' + playername + '\n'
+                line = self._slot_labels[ind] + '\n'
+            self._fragments[ind] = (player, tag, line)
+        return line
 
-        body += '\U0001F534 {}\n'.format(self.team2_name)
-        for j, player in enumerate(team2):
-            if player:
-                playername = '<@' + player + '>'
-
-                if player == self['host']:
-                    playername += '\U0001F451'
-                elif player in self['ready']:
-                    playername += ' <- ready!'
-                elif player in self['needsub']:
-                    playername += ' <- NEEDS SUB! Type \"!sub {}\"'.format(self['id'])          
+    def _player_tag(self, ind, player):
+        if not player:
+            return ''
+
+        if player == self.host:
+            tag = '\U0001F451'
+        elif player in self.ready:
+            tag = ' <- ready!'
+        elif player in self.needsub:
+            if ind < self.max_players_team:
+                tag = ' <- NEEDS SUB!!'
             else:
-                playername = ''
-            body += '        ' + str(j + self.max_players_team + 1) + '. ' + playername + '\n'
+                tag = ' <- NEEDS SUB! Type \"!sub {}\"'.format(self.id)
+        else:
+            tag = ''
+        return tag
+
+    def _render(self):
+        num_players = self.max_players - self.players.count(None)
+        mutiny_threshold = (num_players // 2) + 1
 
-        header = '#{} **{} [{}/{}]** '.format(self['id'], self['mode'], num_players, self.max_players)
+        header = ['#{} **{} [{}/{}]** '.format(self.id, self.mode, num_players, self.max_players)]
 
-        if num_players == 0 or len(self['mutinies']) >= (num_players // 2) + 1:
-            header += '(cancelled)\n'
-        elif self['status'] == 0:
+        if num_players == 0 or len(self.mutinies) >= mutiny_threshold:
+            header.append('(cancelled)\n')
+        elif self.status == 0:
             if num_players == self.max_players:
-                header += '(waiting for host to start)\n'
+                header.append('(waiting for host to start)\n')
             else:
-                header += '(waiting for players)\n'
-        elif self['status'] == 1:
-            header += '(post-game | {} won)\n'.format(self.team1_name)
-        elif self['status'] == 2:
-            header += '(post-game | {} won)\n'.format(self.team2_name)
+                header.append('(waiting for players)\n')
+        elif self.status == 1:
+            header.append('(post-game | {} won)\n'.format(self.team1_name))
+        elif self.status == 2:
+            header.append('(post-game | {} won)\n'.format(self.team2_name))
         else:
-            header += '\U00002757 LIVE \U00002757\n'
-            if len(self['mutinies']) > 0:
-                body += '[{}/{}] cancel votes.\n'.format(len(self['mutinies']), (num_players // 2) + 1)
-            if self['map'] != '':
-                body += 'Suggested map: {}\n'.format(self['map'])
-        
-        if self['note']:
-            header += '*' + self['note'] + '*\n'
-        return header + body  
\ No newline at end of file
+            header.append('\U00002757 LIVE \U00002757\n')
+
+        if self.note:
+            header.append('*' + self.note + '*\n')
+
+        body = ['\U0001F535 {}\n'.format(self.team1_name)]
+        for i, player in enumerate(self.players):
+            if i == self.max_players_team:
+                body.append('\U0001F534 {}\n'.format(self.team2_name))
+            body.append(self._player_fragment(i, player))
+
+        if self.status == Match.LIVE and num_players and len(self.mutinies) < mutiny_threshold:
+            if len(self.mutinies) > 0:
+                body.append('[{}/{}] cancel votes.\n'.format(len(self.mutinies), mutiny_threshold))
+            if self.map != '':
+                body.append('Suggested map: {}\n'.format(self.map))
+
+        return ''.join(header + body)
@@ -1,11 +1,12 @@
 import asyncio
+import heapq
 import random
+import time
 
 import discord
 
-from .match import Match
+from .match import Match, MessageRef
 from .exceptions import MatchError
-from .database import QCDB
 
 class Pug:
     """Mostly functions that control the flow and status of matches. Does
@@ -25,23 +26,64 @@ class Pug:
         of active matches in the database that act as a buffer between
         the database and output to discord.
 
-    self.banned (dict, key: str, val: (int, str))
-        dict of banned users containing a tuple which has the reason for
-        and a length of the ban. these bans are temporary and are lost if
-        the bot goes down. for permabanning the server admins should strip
-        the target player of their PUG role.
+    self.p_index (dict, key: str, val: int)
+        player id -> id of the match they're in.
+
+    self.h_index (dict, key: str, val: int)
+        host id -> id of the match they host.
+
+    self.msg_index (dict, key: str, val: int)
+        lobby message id -> id of the match it shows, for routing reactions.
+
+        the indexes are kept in sync with m_cache by the _add_match,
+        _remove_match, _set_player, _set_host and _set_message helpers,
+        which every change to a roster, host or lobby message has to go
+        through. check_index() verifies them.
+
+    self.locks (dict, key: int, val: asyncio.Lock)
+        one lock per active match. the public entry points (*_search,
+        *_direct) hold it for the whole operation so changes to a lobby
+        can't interleave across awaits, while different lobbies still
+        run concurrently. the private functions expect the caller to hold
+        it and never take it themselves. since the match may be gone or
+        changed by the time the lock is acquired, everything is looked up
+        again after acquiring it.
+
+    self.joining (dict, key: str, val: [int, int])
+        players that are in the middle of creating or joining a lobby ->
+        [id of the lobby (None when creating one), calls in progress].
+        they are added before the first await so the same player can't end
+        up in two lobbies at once (which the per-match locks don't cover).
+        joining the same lobby again while the first join is running just
+        waits its turn on the lobby's lock.
+
+    self.banned (dict, key: str, val: (int, int, str))
+        dict of banned users containing a tuple which has the time the ban
+        expires (unix timestamp), its length in minutes and the reason for
+        it. bans are saved in the database and loaded again on startup.
+        for permabanning the server admins should strip the target player
+        of their PUG role.
+
+    self.ban_heap (list [(int, str)])
+        heap of (expires, user id) so the ban that expires next is always
+        first. a single timer lifts bans as they expire instead of one
+        sleeping task per ban. entries for bans that were lifted early
+        are skipped when they come up.
 
     self.maplist (dict, key: str, val: list [str])
         contains appropriate gamemodes for each map in QC.
-
-    todo:
-        make bans stay after the bot goes down. right now the only way to
-        permaban someone is by removing their PUG role
     """
     
     def __init__(self, maplist):
         self.m_cache = {}
+        self.p_index = {}
+        self.h_index = {}
+        self.msg_index = {}
+        self.locks = {}
+        self.joining = {}
         self.banned = {}
+        self.ban_heap = []
+        self._ban_timer = None
         self.maplist = maplist
 
     class _check:
@@ -53,22 +95,15 @@ class Pug:
         @classmethod
         def role(cls, func):
             async def deco(pug, bot, user_id, *args, **kwargs):
-                if bot.conf.pug_role.id == bot.server.id:
+                if bot.conf.pug_role.id == bot.server.id or bot.has_role(user_id, bot.conf.pug_role.id):
                     await func(pug, bot, user_id, *args, **kwargs)
-                else:
-                    member = discord.utils.get(bot.server.members, id=user_id)
-                    if member:
-                        for role in member.roles:
-                            if role.id == bot.conf.pug_role.id:
-                                await func(pug, bot, user_id, *args, **kwargs)
-                                break
             return deco
 
         @classmethod
         def ban(cls, func):
             async def deco(pug, bot, user_id, *args, **kwargs):
                 if user_id in pug.banned:
-                    fmt = (pug.banned[user_id][1], pug.banned[user_id][0])
+                    fmt = (pug.banned[user_id][2], pug.banned[user_id][1])
                     errmsg = 'User is on cooldown. Reason: \"{}\" Duration: {} min'.format(*fmt)
                     raise MatchError(errmsg)
                     
@@ -78,21 +113,75 @@ class Pug:
         @classmethod
         def dbentry(cls, func):
             async def deco(pug, bot, user_id, *args, **kwargs):
-                if not bot.db.get_player_record(user_id):
-                    bot.db.add_player(user_id, 'UNK')
+                if not await bot.db.get_player_record(user_id):
+                    await bot.db.add_player(user_id, 'UNK')
 
                 await func(pug, bot, user_id, *args, **kwargs)
             return deco
 
-    def ban(self, loop, user_id, minutes, reason):
+    async def ban(self, bot, user_id, minutes, reason):
+        if user_id not in self.banned:
+            expires = int(time.time()) + minutes * 60
+            self._add_ban(bot.client.loop, user_id, expires, minutes, reason)
+            await bot.db.add_ban(user_id, expires, minutes, reason)
+
+    async def unban(self, bot, user_id):
+        """Lifts a ban early.
+
+        returns: bool (True if the user was banned)
+        """
+
         if user_id not in self.banned:
-            self.banned[user_id] = (minutes, reason)
-            loop.create_task(self.unban(user_id, minutes))
+            return False
 
-    async def unban(self, user_id, minutes):
-        await asyncio.sleep(minutes * 60)
         del self.banned[user_id]
-        
+        await bot.db.remove_ban(user_id)
+        return True
+
+    def close(self):
+        """Stops the ban timer, for when the bot shuts down."""
+
+        if self._ban_timer:
+            self._ban_timer.cancel()
+            self._ban_timer = None
+
+    async def load_bans(self, bot):
+        now = int(time.time())
+        await bot.db.remove_expired_bans(now)
+        for user_id, expires, minutes, reason in await bot.db.get_bans(now):
+            self._add_ban(bot.client.loop, user_id, expires, minutes, reason)
+
+    def _add_ban(self, loop, user_id, expires, minutes, reason):
+        self.banned[user_id] = (expires, minutes, reason)
+
+        #only move the timer up if this ban expires before all the others
+        sooner = not self.ban_heap or expires < self.ban_heap[0][0]
+        heapq.heappush(self.ban_heap, (expires, user_id))
+        if sooner:
+            self._schedule_unban(loop)
+
+    def _schedule_unban(self, loop):
+        if self._ban_timer:
+            self._ban_timer.cancel()
+            self._ban_timer = None
+
+        if self.ban_heap:
+            delay = max(0, self.ban_heap[0][0] - time.time())
+            self._ban_timer = loop.call_later(delay, self._expire_bans, loop)
+
+    def _expire_bans(self, loop):
+        now = time.time()
+        while self.ban_heap and self.ban_heap[0][0] <= now:
+            expires, user_id = heapq.heappop(self.ban_heap)
+            #skip bans that were already lifted (or lifted and given again)
+            ban = self.banned.get(user_id)
+            if ban and ban[0] == expires:
+                del self.banned[user_id]
+
+        self._ban_timer = None
+        self._schedule_unban(loop)
+
+
     async def on_ready(self, bot):
         pug_help = (
             '#**REACTION SHORTCUTS**\n'
@@ -112,41 +201,175 @@ class Pug:
                 bot.shortcuts['cancel'],
                 bot.shortcuts['leave'])
 
-        await bot.client.send_message(bot.conf.pug_chan, pug_help)
+        await self.load_bans(bot)
+
+        #pick up the lobbies that were active when the bot went down
+        matches = await bot.db.get_active_matches()
+        await asyncio.gather(*[self._restore_match(bot, *match) for match in matches])
+
+        #clear out everything else in the channel but keep one copy of
+        #the help message if it hasn't changed
+        help_msgs = []
+        def is_stale(message):
+            if message.id in self.msg_index:
+                return False
+            if message.author.id == bot.server.me.id and message.content == pug_help and not help_msgs:
+                help_msgs.append(message)
+                return False
+            return True
+
+        await bot.client.purge_from(bot.conf.pug_chan, check=is_stale)
+
+        if not help_msgs:
+            await bot.client.send_message(bot.conf.pug_chan, pug_help)
+
+    async def _restore_match(self, bot, match_id, host_id, mode, status, msg_id):
+        """Puts an active match from the database back in the cache and
+        re-attaches it to its lobby message, sending a new one if the old
+        message is gone. The message is only edited if what it shows is
+        out of date."""
+
+        players = await bot.db.get_all_players_in_match(match_id, bot.conf.modes[mode])
+        match = Match(bot.conf, match_id, host_id, mode, players=players, status=status)
+        self._add_match(match_id, match)
+
+        msg = None
+        if msg_id:
+            try:
+                msg = await bot.client.get_message(bot.conf.pug_chan, msg_id)
+            except discord.DiscordException:
+                pass
+
+        if status == Match.LOBBY:
+            shortcuts = ('join_blue', 'join_red', 'ready', 'leave')
+        else:
+            shortcuts = ('end_blue', 'end_red', 'cancel', 'leave')
+        reactions = [bot.shortcuts[s] for s in shortcuts]
+
+        if msg:
+            if msg.content != str(match):
+                msg = await bot.client.edit_message(msg, str(match))
+            if [r.emoji for r in msg.reactions if r.me] != reactions:
+                bot.reactions.clear(msg)
+                bot.reactions.add(msg, *reactions)
+        else:
+            msg = await bot.client.send_message(bot.conf.pug_chan, str(match))
+            await bot.db.set_match_message(match_id, msg.id)
+            bot.reactions.add(msg, *reactions)
+
+        bot.edits.shown(msg, match)
+        self._set_message(match_id, match, msg)
 
-        matches = bot.db.get_active_matches()
-        for match in matches:
-            await asyncio.sleep(1)
+    #~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~cache/index bookkeeping
+    #~~~~~~~~~~~~~~~~~~~~~~~~~
 
-            players = bot.db.get_all_players_in_match(match[0])
-            self.m_cache[match[0]] = Match(bot.conf, match[0], match[1],
-                                           match[2], players=players, status=match[3])
-            
-            msg = await bot.client.send_message(bot.conf.pug_chan, str(self.m_cache[match[0]]))
-            self.m_cache[match[0]]['message'] = msg
-
-            if match[3] == Match.LOBBY:
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['join_blue'])
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['join_red'])
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['ready'])
-            elif match[3] == Match.LIVE:
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['end_blue'])
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['end_red'])
-                await asyncio.sleep(1)
-                await bot.client.add_reaction(msg, bot.shortcuts['cancel'])
-
-            await asyncio.sleep(1)
-            await bot.client.add_reaction(msg, bot.shortcuts['leave'])
+    def _add_match(self, match_id, match):
+        self.m_cache[match_id] = match
+        for player in match['players']:
+            if player:
+                self.p_index[player] = match_id
+        self.h_index[match['host']] = match_id
+
+    def lock(self, match_id):
+        """returns: asyncio.Lock for the match. hold it while changing the
+        match from outside the entry points (e.g. mod commands)."""
+
+        lock = self.locks.get(match_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            #don't keep locks around for lobby numbers that don't exist
+            if match_id in self.m_cache:
+                self.locks[match_id] = lock
+        return lock
+
+    def _remove_match(self, match_id):
+        match = self.m_cache.pop(match_id)
+        self.locks.pop(match_id, None)
+        for player in match['players']:
+            if player and self.p_index.get(player) == match_id:
+                del self.p_index[player]
+        if self.h_index.get(match['host']) == match_id:
+            del self.h_index[match['host']]
+        if match['message'] and self.msg_index.get(match['message'].id) == match_id:
+            del self.msg_index[match['message'].id]
+        return match
+
+    def _set_player(self, match_id, match, ind, player_id):
+        """Puts player_id (or None to empty it) in a slot of the lobby."""
+
+        old = match['players'][ind]
+        if old and self.p_index.get(old) == match_id:
+            del self.p_index[old]
+
+        match.set_player(ind, player_id)
+        if player_id:
+            self.p_index[player_id] = match_id
+
+    def _set_host(self, match_id, match, host_id):
+        if self.h_index.get(match['host']) == match_id:
+            del self.h_index[match['host']]
+
+        match['host'] = host_id
+        self.h_index[host_id] = match_id
+
+    def _set_message(self, match_id, match, msg):
+        """Sets the discord message that shows the lobby. Only its id
+        and channel are kept."""
+
+        if match['message'] and self.msg_index.get(match['message'].id) == match_id:
+            del self.msg_index[match['message'].id]
+
+        match['message'] = MessageRef(msg.id, msg.channel)
+        self.msg_index[msg.id] = match_id
+
+    def match_by_message(self, message_id):
+        """returns: (match id, Match) shown by the message or (None, None)"""
+
+        m_id = self.msg_index.get(message_id)
+        if m_id is None:
+            return None, None
+        return m_id, self.m_cache[m_id]
+
+    def _match_of(self, user_id):
+        """returns: (match id, Match) the user is playing in or (None, None)"""
+
+        m_id = self.p_index.get(user_id)
+        if m_id is None:
+            return None, None
+        return m_id, self.m_cache[m_id]
+
+    def _match_hosted_by(self, user_id):
+        """returns: (match id, Match) the user is hosting or (None, None)"""
+
+        m_id = self.h_index.get(user_id)
+        if m_id is None:
+            return None, None
+        return m_id, self.m_cache[m_id]
+
+    def check_index(self):
+        """Raises AssertionError if p_index, h_index or msg_index don't
+        match what's actually in m_cache."""
+
+        players = {}
+        hosts = {}
+        messages = {}
+        for m_id, match in self.m_cache.items():
+            for player in match['players']:
+                if player:
+                    assert player not in players, '{} is in lobbies {} and {}'.format(player, players[player], m_id)
+                    players[player] = m_id
+            hosts[match['host']] = m_id
+            if match['message']:
+                messages[match['message'].id] = m_id
+
+        assert players == self.p_index, 'player index out of sync: {} != {}'.format(self.p_index, players)
+        assert hosts == self.h_index, 'host index out of sync: {} != {}'.format(self.h_index, hosts)
+        assert messages == self.msg_index, 'message index out of sync: {} != {}'.format(self.msg_index, messages)
 
     def __offset_slot(self, max_players_team, slot):
-        """Helper for translating a match lobby slot (1-8) to
-        the actual index of the player list. This is for commands like
-        !kick and !swap
+        """Helper for translating a match lobby slot to the index of
+        the player list. This is for commands like !kick and !swap
 
             Players see the playerlist in lobbies as:
             Team 1
@@ -156,27 +379,40 @@ class Pug:
                 3. guy
                 4. person
 
-            But internally this is stored in a list as:
-            [dude, None, None, None, guy, person, None, None]
+            Internally this is stored in a list as:
+            [dude, None, guy, person]
 
-            So "!kick 3" would be for 'guy' who is in slot 3 but actual index
-            in the list is 4
+            So "!kick 3" would be for 'guy' at index 2. Out of range
+            slots are clamped to the size of the gamemode.
         """
 
         #clamp slot number to min or max of the gamemode
         if slot < 0:
-            ind = 0
+            return 0
         elif slot > (max_players_team * 2) - 1:
-            ind = (max_players_team * 2) - 1
+            return (max_players_team * 2) - 1
         else:
-            ind = slot
+            return slot
 
-        #if the slot is on team2, offset it to find the real position in playerlist
-        if slot >= max_players_team:
-            ind += QCDB.MAX_SLOTS - max_players_team
 
-        #return real index in playerlist
-        return ind
+    def _reserve(self, user_id, match_id):
+        """Marks the player as on their way into match_id (None for a
+        lobby they're creating). Raises MatchError if they're already on
+        their way into a different lobby, or creating one."""
+
+        pending = self.joining.get(user_id)
+        if pending is None:
+            self.joining[user_id] = [match_id, 1]
+        elif match_id is not None and pending[0] == match_id:
+            pending[1] += 1
+        else:
+            raise MatchError('You cannot be in more than one lobby at a time.')
+
+    def _release(self, user_id):
+        pending = self.joining[user_id]
+        pending[1] -= 1
+        if not pending[1]:
+            del self.joining[user_id]
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -187,35 +423,43 @@ class Pug:
     @_check.ban
     @_check.dbentry
     async def create_match(self, bot, user_id, user_name, mode, note):
-        for m_id in self.m_cache:
-            if user_id in self.m_cache[m_id]['players']:
-                raise MatchError('You cannot be in more than one lobby at a time.')
-
-        #create match in database
-        match_id = bot.db.create_match(user_id, mode)
-        match = bot.db.get_match(match_id)
-        players = bot.db.get_all_players_in_match(match_id)
+        if user_id in self.p_index:
+            raise MatchError('You cannot be in more than one lobby at a time.')
 
-        #add match to active matches cache
-        self.m_cache[match_id] = Match(bot.conf, match_id, match[1], match[2],
-                                       players=players, note=note)
+        self._reserve(user_id, None)
+        try:
+            await self._create_match(bot, user_id, user_name, mode, note)
+        finally:
+            self._release(user_id)
 
-        #send message to pug channel with new lobby
-        msg = await bot.client.send_message(bot.conf.pug_chan, str(self.m_cache[match_id]))
-        self.m_cache[match_id]['message'] = msg
+    async def _create_match(self, bot, user_id, user_name, mode, note):
+        #create match in database
+        match_id = await bot.db.create_match(user_id, mode)
+        if match_id is None:
+            raise MatchError('Could not create the lobby.')
+
+        #add match to active matches cache, the host starts in the first slot
+        players = [None] * (bot.conf.modes[mode] * 2)
+        players[0] = user_id
+        self._add_match(match_id, Match(bot.conf, match_id, user_id, mode,
+                                        players=players, note=note))
+
+        #send message to pug channel with new lobby. nobody can join
+        #until it's sent, so the message matches the lobby's version
+        async with self.lock(match_id):
+            msg = await bot.client.send_message(bot.conf.pug_chan, str(self.m_cache[match_id]))
+            bot.edits.shown(msg, self.m_cache[match_id])
+            self._set_message(match_id, self.m_cache[match_id], msg)
+        await bot.db.set_match_message(match_id, msg.id)
 
         brd_fmt = (user_name, mode, match_id, bot.conf.pug_chan.id, bot.conf.prefix, match_id)
         brd_msg = '**{}** created **{}** lobby #{} in <#{}> `\"{}join {}\" to play.`'.format(*brd_fmt)
         await bot.broadcast(1, brd_msg)
-        
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(msg, bot.shortcuts['join_blue'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(msg, bot.shortcuts['join_red'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(msg, bot.shortcuts['ready'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(msg, bot.shortcuts['leave'])
+
+        bot.reactions.add(msg, bot.shortcuts['join_blue'],
+                               bot.shortcuts['join_red'],
+                               bot.shortcuts['ready'],
+                               bot.shortcuts['leave'])
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -223,8 +467,10 @@ class Pug:
     #~~~~~~~~~~~~~~~~~~~~~~~~~
 
     async def _join_match(self, bot, user_id, user_name, match_id, match, team=''):
-        team1_players = [ p for p in bot.db.get_players_on_team(match_id, 'team1') if p ]
-        team2_players = [ p for p in bot.db.get_players_on_team(match_id, 'team2') if p ]
+        team1 = await bot.db.get_players_on_team(match_id, 'team1')
+        team2 = await bot.db.get_players_on_team(match_id, 'team2')
+        team1_players = [ p for p in team1 if p ]
+        team2_players = [ p for p in team2 if p ]
         team1_num_players = len(team1_players)
         team2_num_players = len(team2_players)
         num_players = team1_num_players + team2_num_players + 1
@@ -237,14 +483,14 @@ class Pug:
             t = team
                 
         #add player to the match in database
-        slot = bot.db.add_player_to_match(match_id, user_id, t, bot.conf.modes[match['mode']])
+        slot = await bot.db.add_player_to_match(match_id, user_id, t, bot.conf.modes[match['mode']])
         if slot == -1:
             raise MatchError('That team or lobby is full.')
 
         #add player to the match in cache
         if t == 'team2':
-            slot += QCDB.MAX_SLOTS
-        match['players'][slot] = user_id
+            slot += bot.conf.modes[match['mode']]
+        self._set_player(match_id, match, slot, user_id)
 
         if num_players == max_players:
             hint = ' `\"{}start\" to go live.`'.format(bot.conf.prefix)
@@ -255,27 +501,31 @@ class Pug:
         brd_msg = '**{}** joined **{}** lobby #{} **[{}/{}]**'.format(*brd_fmt)
         await bot.broadcast(2, brd_msg + hint)
 
-        await bot.client.edit_message(match['message'], str(match))
+        bot.edits.mark(match['message'], match)
 
     @_check.role
     @_check.ban
     @_check.dbentry
     async def join_match_direct(self, bot, user_id, user_name, match_id, team=''):
-        for m_id in self.m_cache:
-            if m_id != match_id and user_id in self.m_cache[m_id]['players']:
-                raise MatchError('You cannot be in more than one lobby at a time.')
-
-        match = self.m_cache.get(match_id)
-        if match:
-            if match['status'] != Match.LOBBY:
-                raise MatchError('That game has already started.')
-
-            if user_id in match['players']:
-                await self._swap_player_to_team(bot, match_id, match, match['players'].index(user_id), team)
-            else:
-                await self._join_match(bot, user_id, user_name, match_id, match, team)
-        else:
-            raise MatchError('Lobby not found.')
+        if self.p_index.get(user_id, match_id) != match_id:
+            raise MatchError('You cannot be in more than one lobby at a time.')
+
+        self._reserve(user_id, match_id)
+        try:
+            async with self.lock(match_id):
+                match = self.m_cache.get(match_id)
+                if match:
+                    if match['status'] != Match.LOBBY:
+                        raise MatchError('That game has already started.')
+
+                    if user_id in match['players']:
+                        await self._swap_player_to_team(bot, match_id, match, match['players'].index(user_id), team)
+                    else:
+                        await self._join_match(bot, user_id, user_name, match_id, match, team)
+                else:
+                    raise MatchError('Lobby not found.')
+        finally:
+            self._release(user_id)
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -284,31 +534,29 @@ class Pug:
 
     async def _leave_match(self, bot, user_id, user_name, match_id, match):
         #remove player from m_cache and database
-        if user_id in match['ready']:
-            match['ready'].remove(user_id)
-        if user_id in match['mutinies']:
-            match['mutinies'].remove(user_id)
+        match.forget(user_id)
 
-        bot.db.remove_player_from_match(match_id, user_id)
         ind = match['players'].index(user_id)
-        match['players'][ind] = None
+        self._set_player(match_id, match, ind, None)
 
         #if leaver is host: find new host or cancel if the lobby becomes empty
+        new_host = None
         if user_id == match['host']:
             for player in match['players']:
                 if player:
-                    match['host'] = player
-                    if player in match['ready']:
-                        match['ready'].remove(player)
-                    bot.db.change_host(match_id, match['host'])
+                    self._set_host(match_id, match, player)
+                    new_host = player
+                    match.set_ready(player, False)
                     break
             else:
                 await self._cancel_match(bot, match_id)
                 return
 
-        if match['status'] == Match.LIVE:
-            self.ban(bot.client.loop, user_id, 5, 'Abandoned a live match.')
-            bot.db.report_ruined_match(user_id)
+        ruined = match['status'] == Match.LIVE
+        await bot.db.drop_player(match_id, user_id, new_host=new_host, ruined=ruined)
+
+        if ruined:
+            await self.ban(bot, user_id, 5, 'Abandoned a live match.')
         else:
             num_players = len([p for p in match['players'] if p])
             max_players = bot.conf.modes[match['mode']] * 2
@@ -317,19 +565,21 @@ class Pug:
             brd_msg = '**{}** left **{}** lobby #{} **[{}/{}]**'.format(*brd_fmt)
             await bot.broadcast(2, brd_msg)
 
-        await bot.client.edit_message(match['message'], str(match))
+        bot.edits.mark(match['message'], match)
         
     async def leave_match_direct(self, bot, user_id, user_name, match_id):
-        match = self.m_cache.get(match_id)
-        if match:
-            if user_id in match['players']:
-                await self._leave_match(bot, user_id, user_name, match_id, match)
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match:
+                if user_id in match['players']:
+                    await self._leave_match(bot, user_id, user_name, match_id, match)
 
     async def leave_match_search(self, bot, user_id, user_name):
-        for m_id, match in self.m_cache.items():
-            if user_id in match['players']:
-                await self._leave_match(bot, user_id, user_name, m_id, match)
-                break
+        m_id, match = self._match_of(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.p_index.get(user_id) == m_id:
+                    await self._leave_match(bot, user_id, user_name, m_id, match)
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -337,43 +587,42 @@ class Pug:
     #~~~~~~~~~~~~~~~~~~~~~~~~~
 
     async def _cancel_match(self, bot, match_id):
-        match = self.m_cache[match_id]
+        match = self._remove_match(match_id)
 
-        bot.db.remove_match(match_id)
-        del self.m_cache[match_id]
+        await bot.db.remove_match(match_id)
 
         await bot.broadcast(3, '**{}** lobby #{} was cancelled.'.format(match['mode'], match_id))
 
-        await bot.client.edit_message(match['message'], str(match))
-        await bot.client.clear_reactions(match['message'])
+        await bot.edits.flush(match['message'], match)
+        bot.reactions.clear(match['message'])
         await asyncio.sleep(5)
+        bot.reactions.cancel(match['message'])
+        bot.edits.forget(match['message'])
         await bot.client.delete_message(match['message'])
 
     async def _mutiny(self, bot, user_id, match_id, match):
-        if user_id in match['mutinies']:
-            match['mutinies'].remove(user_id)
-        else:
-            match['mutinies'].append(user_id)
+        match.set_mutiny(user_id, user_id not in match['mutinies'])
 
         #cancel match if mutiny votes exceeds half of num_players + 1
         num_players = len([p for p in match['players'] if p])
         if len(match['mutinies']) >= (num_players // 2) + 1:
             await self._cancel_match(bot, match_id)
         else:
-            await bot.client.edit_message(match['message'], str(match))
+            bot.edits.mark(match['message'], match)
 
     async def cancel_match_direct(self, bot, user_id, match_id):
-        match = self.m_cache.get(match_id)
-        if match:
-            if match['status'] == Match.LIVE and user_id in match['players']:
-                await self._mutiny(bot, user_id, match_id, match)
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match:
+                if match['status'] == Match.LIVE and user_id in match['players']:
+                    await self._mutiny(bot, user_id, match_id, match)
      
     async def cancel_match_search(self, bot, user_id):
-        for m_id, match in self.m_cache.items():
-            if user_id in match['players']:
-                if match['status'] == Match.LIVE:
+        m_id, match = self._match_of(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.p_index.get(user_id) == m_id and match['status'] == Match.LIVE:
                     await self._mutiny(bot, user_id, m_id, match)
-                break
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -389,21 +638,20 @@ class Pug:
             num_maps = len(self.maplist[match['mode']])
             match['map'] = self.maplist[match['mode']][random.randrange(num_maps)]
 
-        match['ready'].clear()
+        match.clear_ready()
         match['status'] = Match.LIVE
 
-        bot.db.update_match(match_id, match['status'])
+        await bot.db.update_match(match_id, match['status'])
 
-        await bot.client.edit_message(match['message'], str(match))
-        await bot.client.clear_reactions(match['message'])
-        await asyncio.sleep(0.25)
+        await bot.edits.flush(match['message'], match)
+        bot.reactions.clear(match['message'])
 
         #notify everyone in the match that their game has started
         notifies = '\n'
         for player in match['players']:
             if player:
                 notifies += '<@' + player + '> '
-                pname = bot.db.get_player_name(player)
+                pname = await bot.db.get_player_name(player)
                 if pname != 'UNK':
                     notifies += '(' + pname + ') '
 
@@ -413,32 +661,33 @@ class Pug:
                    'or \"!end {}\" to report a winner.`{}')
         await bot.broadcast(1, brd_msg.format(*brd_fmt))
 
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(match['message'], bot.shortcuts['end_blue'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(match['message'], bot.shortcuts['end_red'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(match['message'], bot.shortcuts['cancel'])
-        await asyncio.sleep(1)
-        await bot.client.add_reaction(match['message'], bot.shortcuts['leave'])
+        bot.reactions.add(match['message'], bot.shortcuts['end_blue'],
+                                            bot.shortcuts['end_red'],
+                                            bot.shortcuts['cancel'],
+                                            bot.shortcuts['leave'])
     
     async def start_match_direct(self, bot, user_id, match_id):
-        match = self.m_cache.get(match_id)
-        if match and user_id == match['host']:
-            num_players = (QCDB.MAX_SLOTS * 2) - match['players'].count(None)
-            if num_players != bot.conf.modes[match['mode']] * 2:
-                raise MatchError('Not enough players to start the match.')
-            
-            chk = len(match['ready']) + 1 != bot.conf.modes[match['mode']] * 2
-            if bot.conf.require_ready and chk:
-                raise MatchError('All players must be ready before starting the match.')
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match and user_id == match['host']:
+                num_players = len(match['players']) - match['players'].count(None)
+                if num_players != bot.conf.modes[match['mode']] * 2:
+                    raise MatchError('Not enough players to start the match.')
+                
+                chk = len(match['ready']) + 1 != bot.conf.modes[match['mode']] * 2
+                if bot.conf.require_ready and chk:
+                    raise MatchError('All players must be ready before starting the match.')
 
-            await self._start_match(bot, match_id, match)
+                await self._start_match(bot, match_id, match)
 
     async def start_match_search(self, bot, user_id):
-        for m_id, match in self.m_cache.items():
-            if user_id == match['host']:
-                num_players = (QCDB.MAX_SLOTS * 2) - match['players'].count(None)
+        m_id, match = self._match_hosted_by(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.h_index.get(user_id) != m_id:
+                    return
+
+                num_players = len(match['players']) - match['players'].count(None)
                 if num_players != bot.conf.modes[match['mode']] * 2:
                     raise MatchError('Not enough players to start the match.')
                 chk = len(match['ready']) + 1 != bot.conf.modes[match['mode']] * 2
@@ -446,7 +695,6 @@ class Pug:
                     raise MatchError('All players must be ready before starting the match.')
 
                 await self._start_match(bot, m_id, match)
-                break
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -458,51 +706,53 @@ class Pug:
             raise MatchError('Match has not started yet.')
 
         #make a list of the winning player ids
+        max_players_team = len(match['players']) // 2
         if winning_team == 'team1':
-            winners = [x for x in range(QCDB.MAX_SLOTS)]
+            winners = [x for x in range(max_players_team)]
             winning_team_id = 1
         elif winning_team == 'team2':
-            winners = [x for x in range(QCDB.MAX_SLOTS, QCDB.MAX_SLOTS * 2)]
+            winners = [x for x in range(max_players_team, max_players_team * 2)]
             winning_team_id = 2
         else:
             raise MatchError('Invalid winning team specified.')
 
-        #report wins to the database
-        for i, player in enumerate(match['players']):
-            if player:
-                win = True if i in winners else False
-                bot.db.report_match(player, win)
-
-        bot.db.update_match(match_id, winning_team_id)
+        #report the result for every player to the database at once
+        winners_ids = [x for x in [match['players'][i] for i in winners] if x is not None]
+        losers_ids = [x for i, x in enumerate(match['players']) if x and i not in winners]
+        await bot.db.finalize_match(match_id, winners_ids, losers_ids, winning_team_id)
 
         #remove match from m_cache
-        match['mutinies'].clear()
+        match.clear_mutinies()
         match['status'] = winning_team_id
-        msg = await bot.client.edit_message(match['message'], str(match))
+        msg = match['message']
+        await bot.edits.flush(msg, match)
 
-        del self.m_cache[match_id]
+        self._remove_match(match_id)
 
         #broadcast the winners
-        winners_ids = [x for x in [match['players'][i] for i in winners] if x is not None]
         winners_names = [discord.utils.get(bot.server.members, id=x).display_name for x in winners_ids]
         brd_fmt = (match['mode'], match_id, ', '.join(winners_names))
         brd_msg = '**{}** lobby #{} has ended. Winner(s): {}.'.format(*brd_fmt)
         await bot.broadcast(3, brd_msg)
 
-        await bot.client.clear_reactions(msg)
+        bot.reactions.clear(msg)
         await asyncio.sleep(5)
+        bot.reactions.cancel(msg)
+        bot.edits.forget(msg)
         await bot.client.delete_message(msg)
 
     async def end_match_direct(self, bot, user_id, match_id, winning_team):
-        match = self.m_cache.get(match_id)
-        if match and user_id == match['host']:
-            await self._end_match(bot, match_id, match, winning_team)
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match and user_id == match['host']:
+                await self._end_match(bot, match_id, match, winning_team)
             
     async def end_match_search(self, bot, user_id, winning_team):
-        for m_id, match in self.m_cache.items():
-            if user_id == match['host']:
-                await self._end_match(bot, m_id, match, winning_team)
-                break
+        m_id, match = self._match_hosted_by(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.h_index.get(user_id) == m_id:
+                    await self._end_match(bot, m_id, match, winning_team)
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -520,24 +770,25 @@ class Pug:
                 raise MatchError('You cannot kick yourself.')
 
             #remove kicked player from match
-            bot.db.remove_player_from_match(match_id, kicked_id)
-            match['players'][ind] = None
+            self._set_player(match_id, match, ind, None)
 
-            if kicked_id in match['mutinies']:
-                match['mutinies'].remove(kicked_id)
-            if kicked_id in match['ready']:
-                match['ready'].remove(kicked_id)
+            match.forget(kicked_id)
+            new_host = None
             if kicked_id == match['host']:
                 for player in match['players']:
                     if player:
-                        match['host'] = player
+                        new_host = player
+                if new_host:
+                    self._set_host(match_id, match, new_host)
+
+            live = match['status'] == Match.LIVE
+            await bot.db.drop_player(match_id, kicked_id, new_host=new_host, loss=live)
 
             #give kicked player a cooldown
-            if match['status'] == -1:
-                self.ban(bot.client.loop, kicked_id, 5, 'Kicked from a live match.')
-                bot.db.report_match(kicked_id, False)
+            if live:
+                await self.ban(bot, kicked_id, 5, 'Kicked from a live match.')
             elif match['status'] == 0:
-                self.ban(bot.client.loop, kicked_id, 1, 'Recently kicked from a lobby.')
+                await self.ban(bot, kicked_id, 1, 'Recently kicked from a lobby.')
             else:
                 raise MatchError('That slot is empty.')
 
@@ -550,7 +801,7 @@ class Pug:
             #if there are any players left in the lobby, update the message
             for player in match['players']:
                 if player:
-                    await bot.client.edit_message(match['message'], str(match))
+                    bot.edits.mark(match['message'], match)
                     break
             else: #otherwise cancel the match
                 await self._cancel_match(bot, match_id)
@@ -558,20 +809,23 @@ class Pug:
             raise MatchError('Slot is empty.')
 
     async def kick_player_direct(self, bot, user_id, match_id, slot, reason=''):
-        match = self.m_cache.get(match_id)
-        if match:
-            ind = self.__offset_slot(bot.conf.modes[match['mode']], slot)
-            await self._kick_player(bot, user_id, match_id, match, ind, reason=reason)
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match:
+                ind = self.__offset_slot(bot.conf.modes[match['mode']], slot)
+                await self._kick_player(bot, user_id, match_id, match, ind, reason=reason)
 
     async def kick_player_search(self, bot, user_id, slot):
-        for m_id, match in self.m_cache.items():
-            if user_id == match['host']:
+        m_id, match = self._match_hosted_by(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.h_index.get(user_id) != m_id:
+                    return
                 if match['status'] != 0:
                     raise MatchError('You cannot kick people after the match has started.')
                 
                 ind = self.__offset_slot(bot.conf.modes[match['mode']], slot)        
                 await self._kick_player(bot, user_id, m_id, match, ind, reason='Kicked by host.')
-                break  
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -582,19 +836,15 @@ class Pug:
         max_players_team = bot.conf.modes[match['mode']]
 
         swap_to = -1
-        if team == 'team1' and ind >= QCDB.MAX_SLOTS:
-            for i, player in enumerate(match['players'][:QCDB.MAX_SLOTS]):
-                if i > max_players_team - 1:
-                    break
+        if team == 'team1' and ind >= max_players_team:
+            for i, player in enumerate(match['players'][:max_players_team]):
                 if not player:
                     swap_to = i
                     break
-        elif team == 'team2' and ind < QCDB.MAX_SLOTS:
-            for j, player in enumerate(match['players'][QCDB.MAX_SLOTS:]):
-                if j > max_players_team - 1:
-                    break
+        elif team == 'team2' and ind < max_players_team:
+            for j, player in enumerate(match['players'][max_players_team:]):
                 if not player:
-                    swap_to = j + QCDB.MAX_SLOTS
+                    swap_to = j + max_players_team
                     break
         else:
             raise MatchError('No valid team to swap to.')        
@@ -603,62 +853,62 @@ class Pug:
             raise MatchError('That team is full.')
 
         tmp = match['players'][ind]
-        match['players'][swap_to] = tmp
-        match['players'][ind] = None
+        match.set_player(swap_to, tmp)
+        match.set_player(ind, None)
 
-        bot.db.change_players_on_team(match_id, 'team1', match['players'][:QCDB.MAX_SLOTS])
-        bot.db.change_players_on_team(match_id, 'team2', match['players'][QCDB.MAX_SLOTS:])
+        await bot.db.set_roster(match_id, match['players'])
         
-        await bot.client.edit_message(match['message'], str(match))
+        bot.edits.mark(match['message'], match)
 
     async def _swap_players(self, bot, match_id, match, ind1, ind2):
         tmp = match['players'][ind1]
         tmp2 = match['players'][ind2]
-        match['players'][ind2] = tmp
-        match['players'][ind1] = tmp2
+        match.set_player(ind2, tmp)
+        match.set_player(ind1, tmp2)
 
         if tmp or tmp2:
-            bot.db.change_players_on_team(match_id, 'team1', match['players'][:QCDB.MAX_SLOTS])
-            bot.db.change_players_on_team(match_id, 'team2', match['players'][QCDB.MAX_SLOTS:])
+            await bot.db.set_roster(match_id, match['players'])
 
-            await bot.client.edit_message(match['message'], str(match))
+            bot.edits.mark(match['message'], match)
 
     async def swap_players_search(self, bot, user_id, slot1, slot2):
-        for m_id, match in self.m_cache.items():
-            if user_id == match['host']:
+        m_id, match = self._match_hosted_by(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.h_index.get(user_id) != m_id:
+                    return
                 if match['status'] != 0:
                     raise MatchError('You cannot swap people after the match has started.')
 
                 max_players_team = bot.conf.modes[match['mode']]
                 ind1 = self.__offset_slot(max_players_team, slot1)
                 ind2 = self.__offset_slot(max_players_team, slot2)
- 
+
                 await self._swap_players(bot, m_id, match, ind1, ind2)
-                break    
       
     #~~~~~~~~~~~~~~~~~~~~~~~~~
     #~give_host
     #~~~~~~~~~~~~~~~~~~~~~~~~~
 
     async def give_host_search(self, bot, user_id, slot):
-        for m_id, match in self.m_cache.items():
-            if user_id == match['host']:
+        m_id, match = self._match_hosted_by(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.h_index.get(user_id) != m_id:
+                    return
+
                 max_players_team = bot.conf.modes[match['mode']]
 
                 if slot < 0 or slot > ((max_players_team * 2) - 1):
                     raise MatchError('Invalid slot number.')
 
-                if slot >= max_players_team:
-                    slot += (QCDB.MAX_SLOTS - max_players_team)
-
                 target_id = match['players'][slot]
                 if target_id:
-                    match['host'] = target_id
-                    if target_id in match['ready']:
-                        match['ready'].remove(target_id)
-                    bot.db.change_host(m_id, target_id)
+                    self._set_host(m_id, match, target_id)
+                    match.set_ready(target_id, False)
+                    await bot.db.change_host(m_id, target_id)
 
-                    await bot.client.edit_message(match['message'], str(match))
+                    bot.edits.mark(match['message'], match)
                 else:
                     raise MatchError('Slot is empty.')
 
@@ -668,26 +918,25 @@ class Pug:
     #~~~~~~~~~~~~~~~~~~~~~~~~~
 
     async def promote_search(self, bot, user_id):
-        for m_id, match in self.m_cache.items():
-            if user_id in match['players']:
-                num_players = (QCDB.MAX_SLOTS * 2) - match['players'].count(None)
-                max_players = bot.conf.modes[match['mode']] * 2
-
-                if match['status'] == 0:
-                    if num_players == max_players:
-                        mention = '<@' + match['host'] + '>'
-                        hint = '(waiting for host to start) `\"{}start\" to go live.`'.format(bot.conf.prefix)
+        m_id, match = self._match_of(user_id)
+        if match:
+            num_players = len(match['players']) - match['players'].count(None)
+            max_players = bot.conf.modes[match['mode']] * 2
+
+            if match['status'] == 0:
+                if num_players == max_players:
+                    mention = '<@' + match['host'] + '>'
+                    hint = '(waiting for host to start) `\"{}start\" to go live.`'.format(bot.conf.prefix)
+                else:
+                    if bot.conf.pug_role.id != bot.server.id:
+                        mention = '<@&' + bot.conf.pug_role.id + '>'
                     else:
-                        if bot.conf.pug_role.id != bot.server.id:
-                            mention = '<@&' + bot.conf.pug_role.id + '>'
-                        else:
-                            mention = ''
-                        hint = '(waiting for players) `\"{}join {}\" to play.`'.format(bot.conf.prefix, m_id)
+                        mention = ''
+                    hint = '(waiting for players) `\"{}join {}\" to play.`'.format(bot.conf.prefix, m_id)
 
-                    await bot.broadcast(1,
-                        '{} **{}** lobby #{} **[{}/{}]** {}'
-                        .format(mention, match['mode'], m_id, num_players, max_players, hint))
-                break
+                await bot.broadcast(1,
+                    '{} **{}** lobby #{} **[{}/{}]** {}'
+                    .format(mention, match['mode'], m_id, num_players, max_players, hint))
 
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -695,11 +944,12 @@ class Pug:
     #~~~~~~~~~~~~~~~~~~~~~~~~~
 
     async def unready(self, bot, user_id, user_name, match_id, match):
+        """Caller has to hold the match's lock."""
+
         if match['status'] == 0 and user_id != match['host']:
-            if user_id in match['ready']:
-                match['ready'].remove(user_id)
+            match.set_ready(user_id, False)
             
-            await bot.client.edit_message(match['message'], str(match))
+            bot.edits.mark(match['message'], match)
             await bot.broadcast(4, '**{}** is no longer ready.'.format(user_name))
 
     async def _ready(self, bot, user_id, user_name, match_id, match, online_status):
@@ -708,28 +958,30 @@ class Pug:
 
         if match['status'] == 0 and user_id != match['host']:
             if user_id in match['ready']:
-                match['ready'].remove(user_id)
+                match.set_ready(user_id, False)
                 await bot.broadcast(4, '**{}** is no longer ready.'.format(user_name))
             else:
-                match['ready'].append(user_id)
+                match.set_ready(user_id, True)
 
                 if len(match['ready']) + 1 == bot.conf.modes[match['mode']] * 2:
                     ready_msg = '<@{}> All players are ready in **{}** lobby #{}. `\"{}start\" to go live.`'
                     ready_msg_fmt = (match['host'], match['mode'], match_id, bot.conf.prefix)
-                    await bot.broadcast(3, ready_msg.format(*ready_msg_fmt))
+                    await bot.broadcast(3, ready_msg.format(*ready_msg_fmt), urgent=True)
                 else:
                     await bot.broadcast(4, '**{}** is ready!'.format(user_name))
 
-            await bot.client.edit_message(match['message'], str(match))
+            bot.edits.mark(match['message'], match)
             
     async def ready_direct(self, bot, user_id, user_name, match_id, online_status):
-        match = self.m_cache.get(match_id)
-        if match:
-            if user_id in match['players']:
-                await self._ready(bot, user_id, user_name, match_id, match, online_status)
+        async with self.lock(match_id):
+            match = self.m_cache.get(match_id)
+            if match:
+                if user_id in match['players']:
+                    await self._ready(bot, user_id, user_name, match_id, match, online_status)
 
     async def ready_search(self, bot, user_id, user_name, online_status):
-        for m_id, match in self.m_cache.items():
-            if user_id in match['players']:
-                await self._ready(bot, user_id, user_name, m_id, match, online_status)
-                break
\ No newline at end of file
+        m_id, match = self._match_of(user_id)
+        if match:
+            async with self.lock(m_id):
+                if self.p_index.get(user_id) == m_id:
+                    await self._ready(bot, user_id, user_name, m_id, match, online_status)
\ No newline at end of file
@@ -0,0 +1,293 @@
+import asyncio
+from collections import deque
+
+import discord
+
+class TokenBucket:
+    """Paces calls to at most `rate` per second on average, allowing
+    bursts of up to `capacity` calls at once.
+    """
+
+    def __init__(self, rate, capacity=1, loop=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.loop = loop or asyncio.get_event_loop()
+        self._tokens = capacity
+        self._last = self.loop.time()
+
+    def _refill(self):
+        now = self.loop.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+
+class ReactionScheduler:
+    """Adds and clears reactions on messages in the background.
+
+    Each channel gets its own queue and worker so one busy channel doesn't
+    hold up another. Requests run in the order they were queued, paced by
+    a token bucket per channel (discord rate limits reactions per channel)
+    instead of fixed sleeps, so callers never wait on them.
+
+    self.rate (float)
+        reaction requests per second allowed in each channel
+    """
+
+    ADD = 0
+    CLEAR = 1
+
+    def __init__(self, client, rate):
+        self.client = client
+        self.rate = rate
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+
+    def add(self, message, *emojis):
+        """Queues emojis to be added to the message, in order."""
+
+        for emoji in emojis:
+            self._queue(message, ReactionScheduler.ADD, emoji)
+
+    def clear(self, message):
+        """Queues clearing every reaction on the message. Adds for the
+        message that are still pending are dropped since they'd be
+        cleared anyway."""
+
+        self.cancel(message)
+        self._queue(message, ReactionScheduler.CLEAR, None)
+
+    def cancel(self, message):
+        """Drops everything pending for the message, like when it's
+        about to be deleted."""
+
+        queue = self._queues.get(message.channel.id)
+        if queue:
+            pending = [req for req in queue if req[0].id != message.id]
+            queue.clear()
+            queue.extend(pending)
+
+    def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+        self._workers.clear()
+        self._queues.clear()
+
+    def _queue(self, message, action, emoji):
+        chan_id = message.channel.id
+        if chan_id not in self._queues:
+            self._queues[chan_id] = deque()
+            self._buckets[chan_id] = TokenBucket(self.rate, loop=self.client.loop)
+
+        self._queues[chan_id].append((message, action, emoji))
+
+        worker = self._workers.get(chan_id)
+        if worker is None or worker.done():
+            self._workers[chan_id] = self.client.loop.create_task(self._work(chan_id))
+
+    async def _work(self, chan_id):
+        queue = self._queues[chan_id]
+        bucket = self._buckets[chan_id]
+
+        while queue:
+            await bucket.acquire()
+            if not queue: #everything was cancelled while waiting
+                break
+
+            message, action, emoji = queue.popleft()
+            try:
+                if action == ReactionScheduler.ADD:
+                    await self.client.add_reaction(message, emoji)
+                else:
+                    await self.client.clear_reactions(message)
+            except discord.errors.NotFound:
+                #message is gone, nothing else for it can succeed
+                self.cancel(message)
+            except discord.DiscordException as e:
+                print('Reaction error: {}'.format(e))
+
+
+class EditCoalescer:
+    """Batches edits to lobby messages.
+
+    Marking a message only schedules an edit `delay` seconds out, and any
+    marks before then ride along with it, so a burst of joins and readies
+    becomes one edit with the latest state. Lobbies are qcbot.match.Match
+    objects: if the lobby's version hasn't moved since the message was
+    last edited nothing is rendered at all, otherwise the edit is still
+    skipped when the text comes out the same.
+
+    self.delay (float)
+        seconds to wait after the first change before editing
+    """
+
+    def __init__(self, client, delay):
+        self.client = client
+        self.delay = delay
+        self._pending = {}
+        self._sent = {}
+        self._timers = {}
+        self._locks = {}
+
+    def shown(self, message, lobby):
+        """Records that the message shows the lobby as it is right now,
+        like right after it's sent."""
+
+        self._sent[message.id] = (lobby.version, str(lobby))
+
+    def mark(self, message, lobby):
+        """Schedules the message to be edited to show str(lobby)."""
+
+        self._pending[message.id] = (message, lobby)
+        if message.id not in self._timers:
+            self._timers[message.id] = self.client.loop.create_task(self._later(message.id))
+
+    async def flush(self, message, lobby):
+        """Edits the message to show str(lobby) right away, for changes
+        that shouldn't wait like a match starting or ending."""
+
+        timer = self._timers.pop(message.id, None)
+        if timer:
+            timer.cancel()
+
+        self._pending[message.id] = (message, lobby)
+        await self._edit(message.id)
+
+    def forget(self, message):
+        """Drops everything kept for the message once it's deleted."""
+
+        timer = self._timers.pop(message.id, None)
+        if timer:
+            timer.cancel()
+        self._pending.pop(message.id, None)
+        self._sent.pop(message.id, None)
+        self._locks.pop(message.id, None)
+
+    def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+
+    async def _later(self, msg_id):
+        await asyncio.sleep(self.delay)
+        del self._timers[msg_id]
+        await self._edit(msg_id)
+
+    async def _edit(self, msg_id):
+        #one edit at a time per message so an older render can't land last
+        lock = self._locks.setdefault(msg_id, asyncio.Lock())
+        async with lock:
+            if msg_id not in self._pending:
+                return
+            message, lobby = self._pending.pop(msg_id)
+
+            version = lobby.version
+            sent_version, sent = self._sent.get(msg_id, (None, None))
+            if version == sent_version:
+                return
+
+            content = str(lobby)
+            if content == sent:
+                self._sent[msg_id] = (version, content)
+                return
+
+            try:
+                await self.client.edit_message(message, content)
+                self._sent[msg_id] = (version, content)
+            except discord.errors.NotFound:
+                self.forget(message)
+            except discord.DiscordException as e:
+                print('Edit error: {}'.format(e))
+
+
+class BroadcastQueue:
+    """Merges broadcasts into digest messages.
+
+    Queued lines wait up to `delay` seconds in a buffer for their channel
+    and are then sent together, split across as few messages as discord's
+    length limit allows. Sending something right away takes whatever is
+    buffered along with it so the channel stays in order.
+
+    self.delay (float)
+        seconds queued lines wait before the digest is sent
+    """
+
+    MAX_LENGTH = 2000
+
+    def __init__(self, client, delay):
+        self.client = client
+        self.delay = delay
+        self._buffers = {}
+        self._timers = {}
+        self._locks = {}
+
+    def queue(self, channel, content):
+        """Adds content to the channel's next digest."""
+
+        self._buffers.setdefault(channel.id, (channel, []))[1].append(content)
+        if channel.id not in self._timers:
+            self._timers[channel.id] = self.client.loop.create_task(self._later(channel.id))
+
+    async def send(self, channel, content):
+        """Sends content now, after anything already buffered."""
+
+        self._buffers.setdefault(channel.id, (channel, []))[1].append(content)
+        await self.flush(channel.id)
+
+    async def flush(self, chan_id):
+        timer = self._timers.pop(chan_id, None)
+        if timer:
+            timer.cancel()
+
+        lock = self._locks.setdefault(chan_id, asyncio.Lock())
+        async with lock:
+            if chan_id not in self._buffers:
+                return
+            channel, lines = self._buffers.pop(chan_id)
+
+            for digest in BroadcastQueue.pack(lines):
+                try:
+                    await self.client.send_message(channel, digest)
+                except discord.DiscordException as e:
+                    print('Broadcast error: {}'.format(e))
+
+    async def flush_all(self):
+        for chan_id in list(self._buffers):
+            await self.flush(chan_id)
+
+    def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._buffers.clear()
+
+    @staticmethod
+    def pack(lines):
+        """Joins lines into as few messages under MAX_LENGTH as possible.
+        A line too long for one message by itself is cut."""
+
+        digests = []
+        current = ''
+        for line in lines:
+            line = line[:BroadcastQueue.MAX_LENGTH]
+            if current and len(current) + 1 + len(line) > BroadcastQueue.MAX_LENGTH:
+                digests.append(current)
+                current = ''
+            current = current + '\n' + line if current else line
+
+        if current:
+            digests.append(current)
+        return digests
+
+    async def _later(self, chan_id):
+        await asyncio.sleep(self.delay)
+        del self._timers[chan_id]
+        await self.flush(chan_id)